@@ -0,0 +1,151 @@
+# The MIT License
+#
+#  Copyright 2015 UB Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+import logging
+import math
+import time
+from functools import wraps
+
+from flask import request, make_response
+from flask.ext.babel import gettext
+from flask.ext.login import current_user
+from redis import RedisError
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+# Token bucket: refill the bucket for the time passed since the last call, then try to take one token. Returns
+# whether the call is allowed and how many seconds to wait for the next token otherwise.
+TOKEN_BUCKET = '''
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts'))
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+if tokens == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens))
+redis.call('HSET', KEYS[1], 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(wait)}
+'''
+
+
+class AdmissionControl(object):
+    '''
+    Concurrency limits per priority class and token bucket rate limits per user and IP address, shared by all worker
+    processes through Redis. The priority classes and their limits are configured in ADMISSION_LIMITS and RATE_LIMITS.
+    Views are limited with the limit() decorator, job workers take and release slots for bulk jobs themselves. Bulk
+    work is only admitted while fewer than ADMISSION_BULK_MAX_INTERACTIVE interactive requests are in flight, so
+    interactive latency does not suffer from exports and imports. If Redis is unavailable, every request is admitted.
+    '''
+    def __init__(self, redis):
+        self.redis = redis
+        self._token_bucket = None
+
+    def _slot_key(self, priority):
+        return 'hb2:admission:%s' % priority
+
+    def acquire(self, priority):
+        key = self._slot_key(priority)
+        in_flight = self.redis.incr(key)
+        # Don't keep slots of crashed workers forever
+        self.redis.expire(key, 600)
+        admitted = in_flight <= secrets.ADMISSION_LIMITS.get(priority)
+        if admitted and priority == 'bulk':
+            interactive = int(self.redis.get(self._slot_key('interactive')) or 0)
+            admitted = interactive < secrets.ADMISSION_BULK_MAX_INTERACTIVE
+        if not admitted:
+            self.redis.decr(key)
+        return admitted
+
+    def release(self, priority):
+        key = self._slot_key(priority)
+        if self.redis.decr(key) < 0:
+            # The counter expired while a long job held its slot
+            self.redis.delete(key)
+
+    def take_token(self, priority, client):
+        '''Return 0 if the client may proceed or the number of seconds until it may try again.'''
+        if self._token_bucket is None:
+            self._token_bucket = self.redis.register_script(TOKEN_BUCKET)
+        rate, burst = secrets.RATE_LIMITS.get(priority)
+        allowed, wait = self._token_bucket(keys=['hb2:rate:%s:%s' % (priority, client)], args=[rate, burst, time.time()])
+        if allowed:
+            return 0
+        return max(1, int(math.ceil(float(wait))))
+
+    def _clients(self):
+        clients = ['ip:%s' % request.access_route[0]]
+        if current_user.is_authenticated:
+            clients.append('user:%s' % current_user.id)
+        return clients
+
+    def limit(self, priority):
+        '''
+        Decorator for views. The priority is a class name from ADMISSION_LIMITS or a callable returning one for the
+        current request.
+        '''
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                myclass = priority() if callable(priority) else priority
+                try:
+                    for client in self._clients():
+                        retry_after = self.take_token(myclass, client)
+                        if retry_after:
+                            return self._reject(gettext('Too Many Requests! Please try again later.'), 429,
+                                                retry_after)
+                    if not self.acquire(myclass):
+                        return self._reject(gettext('The server is busy! Please try again later.'), 503,
+                                            secrets.ADMISSION_RETRY_AFTER)
+                except RedisError as e:
+                    logging.error(e)
+                    return view(*args, **kwargs)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    try:
+                        self.release(myclass)
+                    except RedisError as e:
+                        logging.error(e)
+            return wrapper
+        return decorator
+
+    def _reject(self, message, status, retry_after):
+        logging.info('Rejected %s with %s, retry after %ss' % (request.path, status, retry_after))
+        resp = make_response(message, status)
+        resp.headers['Retry-After'] = str(retry_after)
+        return resp
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+'''
+Per-record cost of the wtf_json -> Solr transform used for bulk re-indexing.
+
+Compares the compiled mapping in solr_mapping with the former chain of field comparisons, both on plain wtf_json
+dicts and without relations, so neither Solr nor WTForms are involved.
+
+    python benchmarks/mapping_benchmark.py [dump.json|dump.ndjson] [--repeat N]
+
+Without a dump a synthetic article is converted 10000 times.
+'''
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import solr_mapping
+
+SAMPLE_RECORD = {
+    'id': '0b9e6a4c-4a5f-4c29-9f55-3c3c2f0d8a11',
+    'created': '2016-02-01 10:12:13.123456',
+    'changed': '2016-03-01 08:09:10.654321',
+    'owner': ['editor@example.org'],
+    'deskman': '',
+    'editorial_status': 'in_process',
+    'publication_status': 'published',
+    'pubtype': 'ArticleJournal',
+    'title': 'On the Indexing of Bibliographic Records ',
+    'translated_title': [],
+    'issued': '2015-11',
+    'publisher': '',
+    'language': ['eng'],
+    'locked': False,
+    'person': [{'name': 'Doe, Jane', 'gnd': '118540238', 'role': 'aut'},
+               {'name': 'Roe, Richard', 'gnd': '', 'role': 'aut'},
+               {'name': 'Poe, Edgar', 'gnd': '', 'role': 'aut'}],
+    'corporation': [{'name': 'Ruhr-Universität Bochum', 'gnd': '2007-5', 'role': 'his'}],
+    'description': 'An abstract. ' * 20,
+    'container_title': 'Journal of Examples',
+    'apparent_dup': False,
+    'ISSN': ['1234-5678'],
+    'DOI': '10.1000/example.1',
+    'PMID': '',
+    'WOSID': '',
+    'is_part_of': [{'is_part_of': '', 'volume': '12', 'issue': '3', 'page_first': '1', 'page_last': '20'}],
+    'has_part': [],
+    'other_version': [],
+    'note': '',
+    'keyword': ['indexing', 'solr'],
+}
+
+
+def legacy_record2solr(data):
+    '''The comparison chain as used by _record2solr_doc before the mapping tables.'''
+    solr_data = {}
+    for field in data:
+        if field == 'id':
+            solr_data.setdefault('id', data.get(field).strip())
+        if field == 'created':
+            solr_data.setdefault('recordCreationDate', data.get(field).strip().replace(' ', 'T') + 'Z')
+        if field == 'changed':
+            solr_data.setdefault('recordChangeDate', data.get(field).strip().replace(' ', 'T') + 'Z')
+        if field == 'owner':
+            for owner in data.get(field):
+                solr_data.setdefault('owner', owner.strip())
+        if field == 'deskman' and data.get(field):
+            solr_data.setdefault('deskman', data.get(field).strip())
+        if field == 'editorial_status':
+            solr_data.setdefault('editorial_status', data.get(field).strip())
+        if field == 'publication_status':
+            solr_data.setdefault('publication_status', data.get(field).strip())
+        if field == 'pubtype':
+            solr_data.setdefault('pubtype', data.get('pubtype').strip())
+        if field == 'title':
+            solr_data.setdefault('title', data.get(field).strip())
+            solr_data.setdefault('exacttitle', data.get(field).strip())
+            solr_data.setdefault('sorttitle', data.get(field).strip())
+        if field == 'translated_title':
+            for trans_tit in data.get(field):
+                solr_data.setdefault('parallel_title', trans_tit.strip())
+        if field == 'issued':
+            if data.get(field):
+                solr_data.setdefault('date', data.get(field).strip())
+                solr_data.setdefault('fdate', data.get(field)[0:4].strip())
+                if len(data.get(field).strip()) == 4:
+                    solr_data.setdefault('date_boost', '%s-01-01T00:00:00Z' % data.get(field).strip())
+                elif len(data.get(field).strip()) == 7:
+                    solr_data.setdefault('date_boost', '%s-01T00:00:00Z' % data.get(field).strip())
+                else:
+                    solr_data.setdefault('date_boost', '%sT00:00:00Z' % data.get(field).strip())
+        if field == 'publisher':
+            solr_data.setdefault('publisher', data.get(field).strip())
+        if field == 'language':
+            for lang in data.get(field):
+                solr_data.setdefault('language', []).append(lang)
+        if field == 'locked':
+            solr_data.setdefault('locked', data.get(field))
+        if field == 'person':
+            for idx, person in enumerate(data.get(field)):
+                if person.get('name'):
+                    solr_data.setdefault('person', []).append(person.get('name').strip())
+                    solr_data.setdefault('fperson', []).append(person.get('name').strip())
+                    if person.get('gnd'):
+                        solr_data.setdefault('pnd', []).append('%s#%s' % (person.get('gnd').strip(), person.get('name').strip()))
+                    else:
+                        solr_data.setdefault('pnd', []).append(
+                            '%s#person-%s#%s' % (data.get('id'), idx, person.get('name').strip()))
+        if field == 'corporation':
+            for idx, corporation in enumerate(data.get(field)):
+                if corporation.get('name'):
+                    solr_data.setdefault('institution', []).append(corporation.get('name').strip())
+                    solr_data.setdefault('fcorporation', []).append(corporation.get('name').strip())
+                    if corporation.get('gnd'):
+                        solr_data.setdefault('gkd', []).append(
+                            '%s#%s' % (corporation.get('gnd').strip(), corporation.get('name').strip()))
+                    else:
+                        solr_data.setdefault('gkd', []).append(
+                                '%s#corporation-%s#%s' % (data.get('id'), idx, corporation.get('name').strip()))
+        if field == 'description':
+            solr_data.setdefault('ro_abstract', data.get(field).strip())
+        if field == 'container_title':
+            solr_data.setdefault('journal_title', data.get(field).strip())
+            solr_data.setdefault('fjtitle', data.get(field).strip())
+        if field == 'apparent_dup':
+            solr_data.setdefault('apparent_dup', data.get(field))
+        if field == 'ISSN':
+            for issn in data.get(field):
+                solr_data.setdefault('issn', issn.strip())
+                solr_data.setdefault('isxn', issn.strip())
+        if field == 'ISBN':
+            for isbn in data.get(field):
+                solr_data.setdefault('isbn', isbn.strip())
+                solr_data.setdefault('isxn', isbn.strip())
+        if field == 'PMID':
+            solr_data.setdefault('pmid', data.get(field).strip())
+        if field == 'DOI':
+            solr_data.setdefault('doi', data.get(field).strip())
+        if field == 'WOSID':
+            solr_data.setdefault('isi_id', data.get(field).strip())
+    return solr_data
+
+
+def load_records(path):
+    import solr_dump
+    with open(path, 'rb') as dump:
+        return list(solr_dump.iter_records(dump))
+
+
+def run(name, convert, records, repeat):
+    seconds = min(timeit.repeat(lambda: [convert(record) for record in records], number=1, repeat=repeat))
+    print('%-10s %8.2f µs/record %10.0f records/s' % (name, seconds / len(records) * 1e6, len(records) / seconds))
+    return seconds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the wtf_json to Solr transform.')
+    parser.add_argument('dump', nargs='?', help='a Solr dump (JSON array or NDJSON) to take the records from')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = load_records(args.dump) if args.dump else [dict(SAMPLE_RECORD) for _ in range(10000)]
+    mismatches = sum(1 for record in records if legacy_record2solr(record) != solr_mapping.record2solr(record))
+    print('%s records, %s with differing output' % (len(records), mismatches))
+    legacy = run('legacy', legacy_record2solr, records, args.repeat)
+    compiled = run('compiled', solr_mapping.record2solr, records, args.repeat)
+    print('speedup    %8.2fx' % (legacy / compiled))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+'''
+Render time of the record rows of dashboard.html and resultlist.html (record_list.html), before and after the docs
+became ResultRows with lazily parsed fields and the template filters were memoized per request.
+
+    python benchmarks/render_benchmark.py [--repeat N]
+
+Before: dicts of all stored fields, mk_time with strptime on every call. After: ResultRows of the projected fields,
+dates parsed by parse_date() once per row. Cached: the rows taken from a warm FragmentCache, as cached_fragment()
+does for hot lists.
+'''
+
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from jinja2 import Environment
+
+from fragment_cache import FragmentCache
+from result_rows_benchmark import DASHBOARD_FIELDS, docs, rows
+
+RESULTLIST_FIELDS = ('id', 'pubtype', 'title', 'person', 'institution', 'circa', 'fdate', 'apparent_dup')
+
+RECORD = '''<a href="/retrieve/{{ record.pubtype }}/{{ record.id }}">{{ record.title }}</a><br/>
+{% if record.person %}{% for author in record.person %}{{ author }}{% if not loop.last %}; {% endif %}{% endfor %}
+{% else %}{% for corp in record.institution %}{{ corp }}{% if not loop.last %}; {% endif %}{% endfor %}{% endif %},
+{% if record.circa == 'y' %}ca. {% endif %}{{ record.fdate }}'''
+
+RESULTLIST = '''{% for record in records %}<li><span>{{ loop.index }}</span><div>''' + RECORD + '''</div>
+{% if record.apparent_dup %}<div>Apparent Duplicate</div>{% endif %}</li>{% endfor %}'''
+
+DASHBOARD = '''{% for record in records %}<tr><th>{{ loop.index }}</th>
+<td>{% if record.locked %}*{% endif %}{{ record.editorial_status|capitalize }}</td><td>''' + RECORD + '''</td>
+<td>{{ now - DATE('recordCreationDate') }}</td><td>{{ now - DATE('recordChangeDate') }}</td>
+<td><a href="/retrieve/{{ record.pubtype }}/{{ record.id }}">View</a>
+{% if not record.locked %}<a href="/update/{{ record.pubtype }}/{{ record.id }}">Edit</a>{% endif %}</td></tr>{% endfor %}'''
+
+
+def strptime_date(mytime):
+    # mk_time before parse_date()
+    try:
+        return datetime.datetime.strptime(mytime, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(mytime, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def cached(env, template):
+    # The loop of the page around cached_fragment(), the row template is rendered on misses only
+    fragments = FragmentCache(100000)
+    row = env.from_string(template.replace('{% for record in records %}', '', 1).rsplit('{% endfor %}', 1)[0])
+
+    def cached_fragment(record, index):
+        key = (record.get('id'), index, record.get('_version_'), 'de_DE', 'admin')
+        fragment = fragments.get(key)
+        if fragment is None:
+            fragment = row.render(record=record, loop={'index': index}, now=datetime.datetime.now())
+            fragments.set(key, fragment)
+        return fragment
+    env.globals['cached_fragment'] = cached_fragment
+    return env.from_string('{% for record in records %}{{ cached_fragment(record, loop.index) }}{% endfor %}')
+
+
+def render_time(template, records, repeat):
+    now = datetime.datetime.now()
+    return min(timeit.repeat(lambda: template.render(records=records, now=now), number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark rendering result rows.')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    env = Environment()
+    env.filters['mk_time'] = strptime_date
+    pages = (
+        ('dashboard', env.from_string(DASHBOARD.replace("DATE('recordCreationDate')",
+                                                        'record.recordCreationDate|mk_time')
+                                      .replace("DATE('recordChangeDate')", 'record.recordChangeDate|mk_time')),
+         env.from_string(DASHBOARD.replace('DATE(', 'record.parsed_date(')), DASHBOARD_FIELDS),
+        ('resultlist', env.from_string(RESULTLIST), env.from_string(RESULTLIST), RESULTLIST_FIELDS),
+    )
+    print('%-10s %6s %12s %12s %12s' % ('page', 'rows', 'before', 'after', 'cached'))
+    for name, before, after, fields in pages:
+        for n in (10, 100, 1000):
+            old = render_time(before, docs(n), args.repeat)
+            new = render_time(after, rows(n, fields), args.repeat)
+            hot = render_time(cached(env, DASHBOARD.replace('DATE(', 'record.parsed_date(') if name == 'dashboard'
+                                     else RESULTLIST), rows(n, fields), args.repeat)
+            print('%-10s %6s %9.2f ms %9.2f ms %9.2f ms' % (name, n, old * 1000, new * 1000, hot * 1000))
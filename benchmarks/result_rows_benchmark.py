@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+'''
+Memory and render time of result pages with the docs as dicts of all stored fields, as dicts of the projected fields
+and as ResultRows of the projected fields, as returned by Solr.request().
+
+    python benchmarks/result_rows_benchmark.py [--repeat N] [--consolidate N]
+
+Solr's parsed response is faked, so the memory is what a Solr object keeps after request() processed it. Pages of
+10, 100 and 1000 dashboard rows are rendered with the row markup of dashboard.html. The memory of the persons
+consolidation is measured for --consolidate docs (default 200000) of its five fields. The field values are shared by
+all docs, so the memory is that of the containers only.
+'''
+
+import argparse
+import datetime
+import gc
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from jinja2 import Environment
+
+import solr_handler
+from solr_handler import Solr, row_type, parse_date
+
+DOC = {
+    'id': '0b9e6a4c-4a5f-4c29-9f55-3c3c2f0d8a11',
+    'pubtype': 'ArticleJournal',
+    'title': 'On the Indexing of Bibliographic Records',
+    'exacttitle': 'On the Indexing of Bibliographic Records',
+    'sorttitle': 'On the Indexing of Bibliographic Records',
+    'person': ['Doe, Jane', 'Roe, Richard', 'Poe, Edgar'],
+    'fperson': ['Doe, Jane', 'Roe, Richard', 'Poe, Edgar'],
+    'pnd': ['118540238#Doe, Jane', '0b9e6a4c#person-1#Roe, Richard', '0b9e6a4c#person-2#Poe, Edgar'],
+    'institution': ['Ruhr-Universität Bochum'],
+    'fdate': '2015',
+    'date': '2015-11',
+    'editorial_status': 'in_process',
+    'publication_status': 'published',
+    'locked': False,
+    'owner': 'editor@example.org',
+    'recordCreationDate': '2016-02-01T10:12:13.123456Z',
+    'recordChangeDate': '2016-03-01T08:09:10.654321Z',
+    'ro_abstract': 'An abstract. ' * 20,
+    'journal_title': 'Journal of Examples',
+    'issn': '1234-5678',
+    'doi': '10.1000/example.1',
+    'wtf_json': '{"title": "On the Indexing of Bibliographic Records", "description": "%s"}' % ('An abstract. ' * 20),
+    '_version_': 1540000000000000000,
+}
+
+# As in hb2_flask, which is not imported so the benchmark does not need Redis
+DASHBOARD_FIELDS = ('id', 'pubtype', 'title', 'person', 'institution', 'circa', 'fdate', 'editorial_status', 'locked',
+                    'recordCreationDate', 'recordChangeDate', 'owner', 'deskman')
+CONSOLIDATE_FIELDS = ['fperson', 'pnd', 'id', 'title', 'pubtype']
+
+DICT_ROW = '''{% for record in records %}<tr><td>{{ record.editorial_status|capitalize }}{% if record.locked %}*{% endif %}</td>
+<td><a href="/retrieve/{{ record.pubtype }}/{{ record.id }}">{{ record.title }}</a> {{ record.person|join('; ') }}, {{ record.fdate }}</td>
+<td>{{ now - record.recordCreationDate|mk_time }}</td><td>{{ now - record.recordChangeDate|mk_time }}</td></tr>{% endfor %}'''
+ROW_ROW = '''{% for record in records %}<tr><td>{{ record.editorial_status|capitalize }}{% if record.locked %}*{% endif %}</td>
+<td><a href="/retrieve/{{ record.pubtype }}/{{ record.id }}">{{ record.title }}</a> {{ record.person|join('; ') }}, {{ record.fdate }}</td>
+<td>{{ now - record.parsed_date('recordCreationDate') }}</td><td>{{ now - record.parsed_date('recordChangeDate') }}</td></tr>{% endfor %}'''
+
+
+def docs(n, fields=None):
+    # Every doc is a copy, as they are when Solr's response is parsed
+    if fields is None:
+        return [dict((field, value) for field, value in DOC.items()) for _ in range(n)]
+    return [dict((field, DOC.get(field)) for field in fields if field in DOC) for _ in range(n)]
+
+
+def rows(n, fields):
+    cls = row_type(fields)
+    return [cls(doc) for doc in docs(n)]
+
+
+def fake_solr(n, fields=None):
+    '''
+    Answer every Solr request with n docs of the given fields. Parsing Solr's python writer output with eval() is
+    slow for large responses, so the parsed response is built directly, with a new dict per doc as eval() does.
+    '''
+    solr_handler._upstream_get = lambda path, node=None, operation='read': None
+    solr_handler._parse = lambda text: {'responseHeader': {'status': 0, 'QTime': 1},
+                                        'response': {'numFound': n, 'start': 0, 'docs': docs(n, fields)}}
+
+
+def request(n, fields=None, compact=False, bulk=False):
+    fake_solr(n, fields)
+    solr = Solr(fields=list(fields or ()), rows=n, compact=compact, bulk=bulk)
+    return memory(lambda: solr.request()), solr.results
+
+
+def memory(run):
+    gc.collect()
+    tracemalloc.start()
+    run()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+
+def render_time(template, records, repeat):
+    now = datetime.datetime.now()
+    return min(timeit.repeat(lambda: template.render(records=records, now=now), number=1, repeat=repeat))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark result rows against dicts.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--consolidate', type=int, default=200000)
+    args = parser.parse_args()
+
+    env = Environment()
+    env.filters['mk_time'] = parse_date
+    dict_template = env.from_string(DICT_ROW)
+    row_template = env.from_string(ROW_ROW)
+
+    solr_handler.secrets.SOLR_COALESCE = False
+    print('%6s %-16s %12s %12s' % ('rows', 'kind', 'memory', 'render'))
+    for n in (10, 100, 1000):
+        for kind, fields, compact, template in (
+                ('all fields', None, False, dict_template),
+                ('projected dict', DASHBOARD_FIELDS, False, dict_template),
+                ('ResultRow', DASHBOARD_FIELDS, True, row_template)):
+            size, results = request(n, fields, compact)
+            seconds = render_time(template, results, args.repeat)
+            print('%6s %-16s %10.1f kB %9.2f ms' % (n, kind, size / 1024.0, seconds * 1000))
+
+    n = args.consolidate
+    print('consolidate_persons, %s docs:' % n)
+    for kind, fields, compact in (('all fields', None, False),
+                                  ('projected dict', CONSOLIDATE_FIELDS, False),
+                                  ('ResultRow', CONSOLIDATE_FIELDS, True)):
+        size, results = request(n, fields, compact, bulk=True)
+        print('       %-16s %10.1f MB' % (kind, size / 1024.0 / 1024.0))
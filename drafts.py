@@ -0,0 +1,121 @@
+# The MIT License
+#
+#  Copyright 2015 UB Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+import logging
+import time
+import uuid
+
+import simplejson as json
+from redis import RedisError
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+DRAFTS_KEY = 'hb2:drafts'
+LOCK_KEY = 'hb2:drafts:lock'
+
+
+class DraftStore(object):
+    '''
+    Unsaved records per user on Redis. Autosaves only replace the draft, it is written to Solr when the record is
+    saved, when the user logs out or when it has not been changed for DRAFT_IDLE_TIMEOUT seconds. Drafts that could
+    not be written expire after DRAFT_TTL seconds.
+    '''
+    def __init__(self, redis):
+        self.redis = redis
+
+    def _member(self, user, record_id):
+        return '%s:%s' % (user, record_id)
+
+    def _key(self, member):
+        return 'hb2:draft:%s' % member
+
+    def save(self, user, record_id, pubtype, data):
+        member = self._member(user, record_id)
+        draft = {'user': user, 'id': record_id, 'pubtype': pubtype, 'data': data, 'changed': time.time()}
+        self.redis.set(self._key(member), json.dumps(draft), ex=secrets.DRAFT_TTL)
+        self.redis.sadd(DRAFTS_KEY, member)
+
+    def get(self, user, record_id):
+        draft = self.redis.get(self._key(self._member(user, record_id)))
+        if draft is None:
+            return None
+        return json.loads(draft)
+
+    def discard(self, user, record_id):
+        member = self._member(user, record_id)
+        self.redis.delete(self._key(member))
+        self.redis.srem(DRAFTS_KEY, member)
+
+    def _drafts(self):
+        for member in self.redis.smembers(DRAFTS_KEY):
+            member = member.decode('utf-8') if isinstance(member, bytes) else member
+            draft = self.redis.get(self._key(member))
+            if draft is None:
+                self.redis.srem(DRAFTS_KEY, member)
+                continue
+            yield json.loads(draft)
+
+    def flush(self, write, user=None, idle=None):
+        '''
+        Call write with every draft, of one user or idle for at least idle seconds, and discard it. Drafts that write
+        fails for are kept. Returns the number of drafts written or None if another process is flushing.
+        '''
+        token = str(uuid.uuid4())
+        if not self.redis.set(LOCK_KEY, token, nx=True, ex=secrets.DRAFT_LOCK_TIMEOUT):
+            return None
+        written = 0
+        try:
+            for draft in self._drafts():
+                if user is not None and draft.get('user') != user:
+                    continue
+                if idle is not None and time.time() - draft.get('changed') < idle:
+                    continue
+                try:
+                    write(draft)
+                except Exception as e:
+                    logging.error('Draft %s of %s could not be written: %s' % (draft.get('id'), draft.get('user'), e))
+                    continue
+                # Only discard what has been written, the user may have autosaved again in the meantime
+                if self.get(draft.get('user'), draft.get('id')) == draft:
+                    self.discard(draft.get('user'), draft.get('id'))
+                written += 1
+        finally:
+            if self.redis.get(LOCK_KEY) == token.encode('utf-8'):
+                self.redis.delete(LOCK_KEY)
+        return written
+
+    def run(self, write, context=None):
+        '''Write idle drafts every DRAFT_FLUSH_INTERVAL seconds. Blocks, so run it in a thread.'''
+        while True:
+            try:
+                if context is None:
+                    self.flush(write, idle=secrets.DRAFT_IDLE_TIMEOUT)
+                else:
+                    with context():
+                        self.flush(write, idle=secrets.DRAFT_IDLE_TIMEOUT)
+            except RedisError as e:
+                logging.error(e)
+            time.sleep(secrets.DRAFT_FLUSH_INTERVAL)
@@ -21,36 +21,54 @@
 #  THE SOFTWARE.
 
 import logging
+import os
 import uuid
+import hashlib
+import threading
 import base64
 import datetime
 import re
+import sqlite3
 import xmlrpc.client
-from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
 
 import requests
+from werkzeug.http import is_resource_modified
 #import pickle
 import humanize
 import simplejson as json
 import wtforms_json
 import orcid
 import time
-from flask import Flask, render_template, redirect, request, jsonify, flash, url_for, Markup, g, send_file
+from flask import Flask, render_template, redirect, request, jsonify, flash, url_for, Markup, g, Response, \
+    stream_with_context, abort, make_response, session
 from flask.ext.babel import Babel, lazy_gettext, gettext
 from flask.ext.bootstrap import Bootstrap
 from flask.ext.paginate import Pagination
 from flask_humanize import Humanize
 from flask.ext.login import LoginManager, UserMixin, current_user, login_user, logout_user, login_required, make_secure_token
-from flask.ext.socketio import SocketIO, emit
+from flask.ext.socketio import SocketIO, emit, join_room
 #from flask_debugtoolbar import DebugToolbarExtension
 from flask_wtf.csrf import CsrfProtect
 from flask_redis import Redis
+from redis import RedisError
 from urllib import parse
 from lxml import etree
 from datadiff import diff_dict
 from fuzzywuzzy import fuzz
 from multiprocessing import Pool
-from solr_handler import Solr
+import solr_handler
+from solr_handler import Solr, SolrUnavailable, ResultRow, encode_wtf_json, decode_wtf_json, get_wtf_json, parse_date
+from admission import AdmissionControl
+from jobs import JobQueue, JobCancelled
+from solr_wal import WriteAheadLog
+from drafts import DraftStore
+from record_store import RecordStore
+from fragment_cache import FragmentCache
+import solr_dump
+import solr_mapping
 from processors import mods_processor
 from forms import *
 
@@ -94,6 +112,15 @@ app.secret_key = secrets.key
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS '] = False
 app.config['REDIS_HOST'] = '/tmp/redis.sock'
 redis_store = Redis(app)
+solr_handler.set_redis(redis_store)
+admission = AdmissionControl(redis_store)
+jobs = JobQueue(redis_store)
+wal = WriteAheadLog(redis_store)
+drafts = DraftStore(redis_store)
+fragments = FragmentCache(secrets.FRAGMENT_CACHE_SIZE)
+record_store = None
+if secrets.RECORD_STORE_PATH:
+    record_store = RecordStore(secrets.RECORD_STORE_PATH)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -258,12 +285,19 @@ def rem_form_count_filter(mystring):
     '''Remove trailing form counts to display only categories in FormField/FieldList combinations.'''
     return FORM_COUNT_RE.sub('', mystring)
 
+def _memoized(kind, value, decode):
+    '''Decode a value once per request, templates often ask for the same date or wtf_json more than once.'''
+    memo = getattr(g, '_memo', None)
+    if memo is None:
+        memo = g._memo = {}
+    key = (kind, value)
+    if key not in memo:
+        memo[key] = decode(value)
+    return memo[key]
+
 @app.template_filter('mk_time')
 def mk_time_filter(mytime):
-    try:
-        return datetime.datetime.strptime(mytime, '%Y-%m-%d %H:%M:%S.%f')
-    except ValueError:
-        return datetime.datetime.strptime(mytime, '%Y-%m-%dT%H:%M:%S.%fZ')
+    return _memoized('date', mytime, parse_date)
 
 @app.template_filter('last_split')
 def last_split_filter(category):
@@ -272,7 +306,26 @@ def last_split_filter(category):
 # Just a temporary hack...
 @app.template_filter('get_name')
 def get_name(record):
-    return json.loads(record.get('wtf_json')).get('name')
+    if isinstance(record, ResultRow):
+        return record.parsed_json().get('name')
+    return _memoized('json', record.get('wtf_json'), decode_wtf_json).get('name')
+
+@app.template_global()
+def cached_fragment(template, record):
+    '''
+    Render a template for a result row, or take it from the fragment cache. Rows are cached by their Solr _version_,
+    the locale and the role of the user, since that is all they depend on.
+    '''
+    version = record.get('_version_')
+    if not version or not secrets.FRAGMENT_CACHE_SIZE:
+        return Markup(render_template(template, record=record))
+    role = current_user.role if current_user.is_authenticated else ''
+    key = (template, record.get('id'), version, get_locale(), role)
+    fragment = fragments.get(key)
+    if fragment is None:
+        fragment = Markup(render_template(template, record=record))
+        fragments.set(key, fragment)
+    return fragment
 
 @app.template_filter('filter_remove')
 def filter_remove_filter(fqstring, category):
@@ -280,7 +333,7 @@ def filter_remove_filter(fqstring, category):
 
 @app.template_filter('deserialize_json')
 def deserialize_json_filter(thejson):
-    return json.loads(thejson)
+    return _memoized('json', thejson, decode_wtf_json)
 
 def theme(ip):
     # logging.info(ip[0])
@@ -357,6 +410,7 @@ def get_locale():
 @app.route('/')
 @app.route('/index')
 @app.route('/homepage')
+@admission.limit('interactive')
 def homepage():
     pagination = ''
     page = int(request.args.get('page', 1))
@@ -429,6 +483,7 @@ def duplicates():
                         header=lazy_gettext('Duplicates'), site=theme(request.access_route), offset=mystart - 1)
 
 @app.route('/persons')
+@admission.limit('interactive')
 def persons():
     page = int(request.args.get('page', 1))
     mystart = 0
@@ -436,7 +491,8 @@ def persons():
     filterquery = request.values.getlist('filter')
 
     persons_solr = Solr(query=query, start=(page - 1) * 10, core='person',
-                        json_facet={'affiliation': {'type': 'term', 'field': 'affiliation'}}, fquery=filterquery)
+                        json_facet={'affiliation': {'type': 'term', 'field': 'affiliation'}}, fquery=filterquery,
+                        fields=['id', 'gnd', 'orcid', 'wtf_json', 'created', 'changed'], compact=True)
     persons_solr.request()
 
     num_found = persons_solr.count()
@@ -466,7 +522,85 @@ def serials():
     return 'Not Implemented Yet'
 
 
+def _facet_cache_key(query, filterquery):
+    return 'hb2:facets:%s' % hashlib.sha1(json.dumps([query, sorted(filterquery)]).encode('utf-8')).hexdigest()
+
+def _store_facets(query, filterquery, facets):
+    try:
+        redis_store.set(_facet_cache_key(query, filterquery), json.dumps({'created': time.time(), 'facets': facets}),
+                        ex=secrets.SOLR_FACET_CACHE_MAX_AGE)
+    except RedisError as e:
+        logging.error(e)
+
+def _refresh_facets(query, filterquery):
+    with app.app_context():
+        try:
+            facet_solr = Solr(query=query, fquery=filterquery, rows=0, json_facet=secrets.SOLR_FACETS)
+            facet_solr.request()
+            _store_facets(query, filterquery, facet_solr.facets)
+        finally:
+            redis_store.delete('%s:refresh' % _facet_cache_key(query, filterquery))
+
+def _cached_facets(query, filterquery):
+    '''
+    Return the cached facet counts for a query and its filters or None on a cache miss. Stale counts are returned as
+    well, but a background thread is started to refresh them. Only one refresh per key runs at a time.
+    '''
+    key = _facet_cache_key(query, filterquery)
+    try:
+        cached = redis_store.get(key)
+        if cached is None:
+            return None
+        cached = json.loads(cached)
+        if time.time() - cached.get('created') > secrets.SOLR_FACET_CACHE_TTL:
+            if redis_store.set('%s:refresh' % key, 1, nx=True, ex=60):
+                threading.Thread(target=_refresh_facets, args=(query, filterquery), daemon=True).start()
+        return cached.get('facets')
+    except RedisError as e:
+        logging.error(e)
+        return None
+
+def _cursor_key(*parts):
+    return 'hb2:cursor:%s' % hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+def _cursor_for_page(key, page):
+    '''
+    Return the cursorMark for a page of a result list if cursor pagination is enabled and the page was reached by
+    paging forward before. An empty string means Solr has to fall back to start/rows.
+    '''
+    if not secrets.SOLR_CURSOR_PAGINATION:
+        return ''
+    if page == 1:
+        return '*'
+    try:
+        cursor = redis_store.hget(key, page)
+    except RedisError as e:
+        logging.error(e)
+        return ''
+    if cursor:
+        return cursor.decode('utf-8')
+    return ''
+
+def _remember_cursor(key, page, cursor):
+    if not cursor:
+        return
+    try:
+        redis_store.hset(key, page, cursor)
+        redis_store.expire(key, secrets.SOLR_CURSOR_TTL)
+    except RedisError as e:
+        logging.error(e)
+
+def _search_priority():
+    '''Searches without query and filters hit the whole index and get limits of their own.'''
+    if request.args.get('q', '') in ('', '*:*') and not request.values.getlist('filter'):
+        return 'browse'
+    return 'interactive'
+
+# The fields shown per record in search results, see record_list.html and resultlist_record.html
+RESULTLIST_FIELDS = ('id', 'pubtype', 'title', 'person', 'institution', 'circa', 'fdate', 'apparent_dup', '_version_')
+
 @app.route('/search')
+@admission.limit(_search_priority)
 def search():
     pagination = ''
     page = int(request.args.get('page', 1))
@@ -483,8 +617,28 @@ def search():
     else:
         sorting = 'fdate desc'
 
-    search_solr = Solr(start=(page - 1) * 10, query=query, fquery=filterquery, sort=sorting, json_facet=secrets.SOLR_FACETS)
-    search_solr.request()
+    cursor_key = _cursor_key('search', query, filterquery, sorting)
+    cursor = _cursor_for_page(cursor_key, page)
+    # Facets don't change between pages of the same query, so only ask Solr for them if they are not cached yet
+    facets = _cached_facets(query, filterquery)
+    if facets is None:
+        try:
+            search_solr = Solr(start=(page - 1) * 10, query=query, fquery=filterquery, sort=sorting, cursor=cursor,
+                               json_facet=secrets.SOLR_FACETS, fields=list(RESULTLIST_FIELDS), compact=True)
+            search_solr.request()
+            facets = search_solr.facets
+            _store_facets(query, filterquery, facets)
+        except SolrUnavailable as e:
+            # Faceting is the expensive part, so try to render the results without facets
+            logging.error(e)
+            search_solr = Solr(start=(page - 1) * 10, query=query, fquery=filterquery, sort=sorting, cursor=cursor,
+                               fields=list(RESULTLIST_FIELDS), compact=True)
+            search_solr.request()
+    else:
+        search_solr = Solr(start=(page - 1) * 10, query=query, fquery=filterquery, sort=sorting, cursor=cursor,
+                           fields=list(RESULTLIST_FIELDS), compact=True)
+        search_solr.request()
+    _remember_cursor(cursor_key, page + 1, search_solr.next_cursor)
     num_found = search_solr.count()
     if num_found == 1:
         return redirect(url_for('show_record', record_id=search_solr.results[0].get('id'), pubtype=search_solr.results[0].get('pubtype')))
@@ -497,7 +651,7 @@ def search():
         #myend = mystart + pagination.per_page - 1
         logging.info(query)
         return render_template('resultlist.html', records=search_solr.results, pagination=pagination,
-                               facet_data=search_solr.facets, header=lazy_gettext('Resultlist'), target='search',
+                               facet_data=facets, header=lazy_gettext('Resultlist'), target='search',
                                site=theme(request.access_route), offset=mystart - 1, query=query,
                                filterquery=filterquery)
 
@@ -513,7 +667,7 @@ def apparent_dup():
         #requests.post('http://%s:%s/solr/%s/update' % (secrets.SOLR_HOST, secrets.SOLR_PORT, secrets.SOLR_CORE),
                       #headers={'Content-type': 'application/json'}, data=json.dumps(data))
         app_dup_solr = Solr(core='hb2', data=[data])
-        app_dup_solr.update()
+        wal.update(app_dup_solr)
     return jsonify(data)
 
 @app.route('/store/mods', methods=['POST'])
@@ -533,207 +687,212 @@ def flash_errors(form):
         for error in errors:
             flash('Error in the %s field: %s' % (getattr(form, field).label.text, error), 'error')
 
-def _record2solr_doc(form, action):
-    if action == 'update':
-        if form.data.get('editorial_status') == 'new':
-            form.editorial_status.data = 'in_process'
-    solr_data = {}
-    wtf = json.dumps(form.data)
-    solr_data.setdefault('wtf_json', wtf)
-    for field in form.data:
-        #logging.info('%s => %s' % (field, form.data.get(field)))
-        if field == 'id':
-            solr_data.setdefault('id', form.data.get(field).strip())
-        if field == 'created':
-            solr_data.setdefault('recordCreationDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        if field == 'changed':
-            solr_data.setdefault('recordChangeDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        if field == 'owner':
-            for owner in form.data.get(field):
-                solr_data.setdefault('owner', owner.strip())
-        if field == 'deskman' and form.data.get(field):
-            solr_data.setdefault('deskman', form.data.get(field).strip())
-        if field == 'editorial_status':
-            solr_data.setdefault('editorial_status', form.data.get(field).strip())
-        if field == 'publication_status':
-            solr_data.setdefault('publication_status', form.data.get(field).strip())
-        if field == 'pubtype':
-            solr_data.setdefault('pubtype', form.data.get('pubtype').strip())
-        if field == 'title':
-            solr_data.setdefault('title', form.data.get(field).strip())
-            solr_data.setdefault('exacttitle', form.data.get(field).strip())
-            solr_data.setdefault('sorttitle', form.data.get(field).strip())
-        if field == 'translated_title':
-            for trans_tit in form.data.get(field):
-                solr_data.setdefault('parallel_title', trans_tit.strip())
-        if field == 'issued':
-            if form.data.get(field):
-                solr_data.setdefault('date', form.data.get(field).strip())
-                solr_data.setdefault('fdate', form.data.get(field)[0:4].strip())
-                if len(form.data.get(field).strip()) == 4:
-                    solr_data.setdefault('date_boost', '%s-01-01T00:00:00Z' % form.data.get(field).strip())
-                elif len(form.data.get(field).strip()) == 7:
-                    solr_data.setdefault('date_boost', '%s-01T00:00:00Z' % form.data.get(field).strip())
-                else:
-                    solr_data.setdefault('date_boost', '%sT00:00:00Z' % form.data.get(field).strip())
-        if field == 'publisher':
-            solr_data.setdefault('publisher', form.data.get(field).strip())
-        if field == 'language':
-            for lang in form.data.get(field):
-                solr_data.setdefault('language', []).append(lang)
-        if field == 'locked':
-            solr_data.setdefault('locked', form.data.get(field))
-        if field == 'person':
-            for idx, person in enumerate(form.data.get(field)):
-                if person.get('name'):
-                    solr_data.setdefault('person', []).append(person.get('name').strip())
-                    solr_data.setdefault('fperson', []).append(person.get('name').strip())
-                    if person.get('gnd'):
-                        solr_data.setdefault('pnd', []).append('%s#%s' % (person.get('gnd').strip(), person.get('name').strip()))
-                    else:
-                        solr_data.setdefault('pnd', []).append(
-                            '%s#person-%s#%s' % (form.data.get('id'), idx, person.get('name').strip()))
-        if field == 'corporation':
-            for idx, corporation in enumerate(form.data.get(field)):
-                if corporation.get('name'):
-                    solr_data.setdefault('institution', []).append(corporation.get('name').strip())
-                    solr_data.setdefault('fcorporation', []).append(corporation.get('name').strip())
-                    if corporation.get('gnd'):
-                        solr_data.setdefault('gkd', []).append(
-                            '%s#%s' % (corporation.get('gnd').strip(), corporation.get('name').strip()))
-                    else:
-                        solr_data.setdefault('gkd', []).append(
-                                '%s#corporation-%s#%s' % (form.data.get('id'), idx, corporation.get('name').strip()))
-        if field == 'description':
-            solr_data.setdefault('ro_abstract', form.data.get(field).strip())
-        if field == 'container_title':
-            solr_data.setdefault('journal_title', form.data.get(field).strip())
-            solr_data.setdefault('fjtitle', form.data.get(field).strip())
-        if field == 'apparent_dup':
-            solr_data.setdefault('apparent_dup', form.data.get(field))
-        if field == 'ISSN':
-            for issn in form.data.get(field):
-                solr_data.setdefault('issn', issn.strip())
-                solr_data.setdefault('isxn', issn.strip())
-        if field == 'ISBN':
-            for isbn in form.data.get(field):
-                solr_data.setdefault('isbn', isbn.strip())
-                solr_data.setdefault('isxn', isbn.strip())
-        if field == 'PMID':
-            solr_data.setdefault('pmid', form.data.get(field).strip())
-        if field == 'DOI':
-            solr_data.setdefault('doi', form.data.get(field).strip())
-        if field == 'WOSID':
-            solr_data.setdefault('isi_id', form.data.get(field).strip())
-        if field == 'is_part_of' and len(form.data.get(field)) > 0:
-            ipo_ids = []
-            ipo_solr = ''
-            try:
-                for ipo in form.data.get(field):
-                    if ipo:
-                        # logging.info(ipo)
-                        if 'is_part_of' in ipo:
-                            # logging.info('POOP')
-                            if ipo.get('is_part_of') != '':
-                                ipo_ids.append(ipo.get('is_part_of'))
-                        else:
-                            # logging.info('PEEP')
-                            ipo_ids.append(ipo)
-                query = ''
-                if len(ipo_ids) > 0:
-                    query = '{!terms f=id}%s' % ','.join(ipo_ids)
-                if len(ipo_ids) == 1:
-                    query = 'id:%s' % ipo_ids[0]
-                if len(ipo_ids) > 0:
-                    ipo_solr = Solr(query=query, facet='false', fields=['wtf_json'])
-                    ipo_solr.request()
-                    if len(ipo_solr.results) == 0:
-                        flash(gettext(
-                            'Not all IDs from relation "is part of" could be found! Ref: %s' % form.data.get('id')),
-                              'warning')
-                    for idx, doc in enumerate(ipo_solr.results):
-                        myjson = json.loads(doc.get('wtf_json'))
-                        # solr_data.setdefault('is_part_of', []).append('<a href="/retrieve/%s/%s">%s</a>' % (myjson.get('pubtype'), myjson.get('id'), myjson.get('title')))
-                        solr_data.setdefault('is_part_of', []).append(json.dumps({'pubtype': myjson.get('pubtype'),
-                                                                                  'id': myjson.get('id'),
-                                                                                  'title': myjson.get('title'),
-                                                                                  'page_first': form.data.get(field)[
-                                                                                      idx].get('page_first', ''),
-                                                                                  'page_last': form.data.get(field)[
-                                                                                      idx].get('page_last', ''),
-                                                                                  'volume': form.data.get(field)[
-                                                                                      idx].get('volume', ''),
-                                                                                  'issue': form.data.get(field)[
-                                                                                      idx].get('issue', '')}))
-            except AttributeError as e:
-                logging.error(e)
-        if field == 'has_part' and len(form.data.get(field)) > 0:
-            # for myhp in form.data.get(field):
-            # logging.info('HP ' + myhp)
-            hp_ids = []
-            hp_solr = ''
-            try:
-                for hp in form.data.get(field):
-                    if hp.get('has_part') != '':
-                        hp_ids.append(hp.get('has_part'))
-                query = ''
-                if len(hp_ids) > 0:
-                    query = '{!terms f=id}%s' % ','.join(hp_ids)
-                if len(hp_ids) == 1:
-                    query = 'id:%s' % hp_ids[0]
-                if len(hp_ids) > 0:
-                    hp_solr = Solr(query=query, facet='false', fields=['wtf_json'])
-                    hp_solr.request()
-                    if len(hp_solr.results) == 0:
-                        flash(
-                            gettext(
-                                'Not all IDs from relation "has part" could be found! Ref: %s' % form.data.get('id')),
-                            'warning')
-                    for doc in hp_solr.results:
-                        myjson = json.loads(doc.get('wtf_json'))
-                        # solr_data.setdefault('has_part', []).append('<a href="/retrieve/%s/%s">%s</a>' % (myjson.get('pubtype'), myjson.get('id'), myjson.get('title')))
-                        solr_data.setdefault('has_part', []).append(json.dumps({'pubtype': myjson.get('pubtype'),
-                                                                                'id': myjson.get('id'),
-                                                                                'title': myjson.get('title'),}))
-            except AttributeError as e:
-                logging.error(e)
-        if field == 'other_version' and len(form.data.get(field)) > 0:
-            # for myov in form.data.get(field):
-            # logging.info('OV ' + myov)
-            ov_ids = []
-            ov_solr = ''
-            try:
-                for version in form.data.get(field):
-                    if version.get('other_version') != '':
-                        ov_ids.append(version.get('other_version'))
-                query = ''
-                if len(ov_ids) > 0:
-                    query = '{!terms f=id}%s' % ','.join(ov_ids)
-                if len(ov_ids) == 1:
-                    query = 'id:%s' % ov_ids[0]
-                if len(ov_ids) > 0:
-                    ov_solr = Solr(query=query, facet='false', fields=['wtf_json'])
-                    ov_solr.request()
-                    if len(ov_solr.results) == 0:
-                        flash(
-                            gettext('Not all IDs from relation "other version" could be found! Ref: %s' % form.data.get(
-                                'id')),
-                            'warning')
-                    for doc in ov_solr.results:
-                        # logging.info(json.loads(doc.get('wtf_json')))
-                        myjson = json.loads(doc.get('wtf_json'))
-                        # solr_data.setdefault('other_version', []).append('<a href="/retrieve/%s/%s">%s</a>' % (myjson.get('pubtype'), myjson.get('id'), myjson.get('title')))
-                        solr_data.setdefault('other_version', []).append(json.dumps({'pubtype': myjson.get('pubtype'),
-                                                                                     'id': myjson.get('id'),
-                                                                                     'title': myjson.get('title'),}))
-            except AttributeError as e:
-                logging.error(e)
+RELATIONS = ('is_part_of', 'has_part', 'other_version')
+# Relation targets are looked up with {!terms f=id} in a GET request, so keep the URL short enough for Jetty
+RELATION_BATCH_SIZE = 100
+
+def _relation_id(entry, relation):
+    if isinstance(entry, dict):
+        return (entry.get(relation) or '').strip()
+    return (entry or '').strip()
+
+def _relation_ids(record):
+    return [_relation_id(entry, relation) for relation in RELATIONS for entry in record.get(relation) or []]
+
+class RelationResolver(object):
+    '''
+    Resolve the IDs in the relations of records to the pubtype, ID and title of the related records. Targets are
+    fetched from Solr in batches and remembered, including the IDs that could not be found, so a bulk import looks
+    each parent journal or collection up only once. Records added with add() take precedence over the index.
+    '''
+    def __init__(self):
+        self.targets = {}
+
+    def add(self, records):
+        for record in records:
+            if record.get('id'):
+                self.targets[record.get('id')] = {'pubtype': record.get('pubtype'), 'id': record.get('id'),
+                                                  'title': record.get('title')}
+
+    def prefetch(self, ids):
+        missing = sorted(set(myid for myid in ids if myid and myid not in self.targets))
+        for start in range(0, len(missing), RELATION_BATCH_SIZE):
+            batch = missing[start:start + RELATION_BATCH_SIZE]
+            relation_solr = Solr(query='{!terms f=id}%s' % ','.join(batch), facet='false', fields=['wtf_json'],
+                                 rows=len(batch))
+            relation_solr.request()
+            self.add(get_wtf_json(doc) for doc in relation_solr.results)
+            for myid in batch:
+                self.targets.setdefault(myid, None)
+
+    def resolve(self, entries, relation):
+        '''Return the (entry, target) pairs of the resolvable entries of a relation and the IDs that were not found.'''
+        ids = [_relation_id(entry, relation) for entry in entries]
+        self.prefetch(ids)
+        found = []
+        missing = []
+        for entry, myid in zip(entries, ids):
+            if not myid:
+                continue
+            if self.targets.get(myid):
+                found.append((entry, self.targets.get(myid)))
+            else:
+                missing.append(myid)
+        return found, missing
+
+def _record2solr_doc(record, action, resolver=None):
+    '''
+    Convert a record to a Solr document. The record is either a form or its data as a wtf_json dict, which spares bulk
+    indexing the construction of the form objects.
+    '''
+    if resolver is None:
+        resolver = RelationResolver()
+    if isinstance(record, dict):
+        data = dict(record)
+        if action == 'update' and data.get('editorial_status') == 'new':
+            data['editorial_status'] = 'in_process'
+    else:
+        if action == 'update':
+            if record.data.get('editorial_status') == 'new':
+                record.editorial_status.data = 'in_process'
+        data = record.data
+    solr_data = {'wtf_json': encode_wtf_json(data)}
+    solr_mapping.record2solr(data, solr_data)
+    for field in RELATIONS:
+        if data.get(field):
+            found, missing = resolver.resolve(data.get(field), field)
+            if missing:
+                flash(gettext('Not all IDs from relation "%(relation)s" could be found! Ref: %(ref)s',
+                              relation=field.replace('_', ' '), ref=data.get('id')), 'warning')
+            for entry, target in found:
+                relation = dict(target)
+                if field == 'is_part_of':
+                    for key in ('page_first', 'page_last', 'volume', 'issue'):
+                        relation[key] = entry.get(key, '') if isinstance(entry, dict) else ''
+                solr_data.setdefault(field, []).append(json.dumps(relation))
+    # Lets the records embedding this one's title be found when it changes
+    relation_ids = sorted(set(myid for myid in _relation_ids(data) if myid))
+    if relation_ids:
+        solr_data['relation_id'] = relation_ids
 
     return solr_data
 
-def _record2solr(form, action=''):
-    record_solr = Solr(core='hb2', data=[_record2solr_doc(form, action=action)])
-    record_solr.update()
+def _stamp_changed(form):
+    '''Set the change date of a record when it is written, not when its form was opened, differential dumps rely on it.'''
+    form.changed.data = str(datetime.datetime.now())
+
+def _record2solr(form, action='', version=None, olddata=None):
+    '''
+    Write a record to Solr through the write-ahead log. If the _version_ the record was read with is given, Solr
+    rejects the update with a 409 if the record was changed in the meantime. If the stored wtf_json is given, only the
+    changed fields are written if possible. Returns None if Solr is unavailable and the write is pending.
+    '''
+    _stamp_changed(form)
+    solr_doc = None
+    if olddata is not None and secrets.SOLR_ATOMIC_UPDATES:
+        solr_doc = _record2solr_atomic(form, olddata)
+    if solr_doc is None:
+        solr_doc = _record2solr_doc(form, action=action)
+    if version:
+        solr_doc['_version_'] = int(version)
+    record_solr = Solr(core='hb2', data=[solr_doc])
+    resp = wal.update(record_solr)
+    _forget_doc('hb2', solr_doc.get('id'))
+    return resp
+
+# Changes to these fields cascade into the whole document or need relation lookups, so they are written in full
+FULL_WRITE_FIELDS = ('id', 'pubtype') + RELATIONS
+
+def _record2solr_atomic(form, olddata):
+    '''
+    Diff the submitted record against the stored wtf_json and return an atomic update setting the Solr fields derived
+    from the changed fields. Returns None if the record has to be written in full.
+    '''
+    if form.data.get('editorial_status') == 'new':
+        form.editorial_status.data = 'in_process'
+    data = form.data
+    changed = [field for field in data if data.get(field) != olddata.get(field)]
+    if any(field in FULL_WRITE_FIELDS for field in changed):
+        return None
+    targets = solr_mapping.affected_targets(solr_mapping.record2solr, changed)
+    if targets is None:
+        return None
+    partial = solr_mapping.record2solr(data, fields=changed)
+    solr_doc = {'id': data.get('id'), 'wtf_json': {'set': encode_wtf_json(data)}}
+    for target in targets:
+        # Setting None removes the field
+        solr_doc[target] = {'set': partial.get(target)}
+    logging.info('Atomic update of %s: %s' % (data.get('id'), ', '.join(sorted(targets)) or 'wtf_json only'))
+    return solr_doc
+
+@jobs.task('propagate_relations')
+def _propagate_relations(job, record_id):
+    '''
+    Rewrite the pubtype and title of a record embedded in the relations of all records referencing it. The records
+    are found by relation_id and written through the write-ahead log in batches of SOLR_PROPAGATION_BATCH_SIZE, as
+    atomic updates of the relation fields if SOLR_ATOMIC_UPDATES is set, otherwise in full from their wtf_json.
+    '''
+    target_solr = Solr(core='hb2', query='id:%s' % record_id, facet='false', fields=['id', 'pubtype', 'title'])
+    target_solr.request()
+    if not target_solr.results:
+        return 0
+    target = target_solr.results[0]
+    done = 0
+    cursor = '*'
+    while True:
+        children_solr = Solr(core='hb2', query='relation_id:"%s"' % record_id, facet='false',
+                             fields=['id', 'wtf_json'] + list(RELATIONS), rows=secrets.SOLR_PROPAGATION_BATCH_SIZE,
+                             sort='id asc', cursor=cursor)
+        children_solr.request()
+        updates = []
+        resolver = RelationResolver()
+        resolver.add([target])
+        for child in children_solr.results:
+            update = _relation_update(child, target)
+            if update and not secrets.SOLR_ATOMIC_UPDATES:
+                update = _record2solr_doc(get_wtf_json(child), action='', resolver=resolver)
+            if update:
+                updates.append(update)
+        if updates:
+            wal.update(Solr(core='hb2', data=updates, commit='false'))
+        done += len(children_solr.results)
+        job.progress(done, children_solr.count(), record=record_id)
+        if not children_solr.results or children_solr.next_cursor == cursor:
+            break
+        cursor = children_solr.next_cursor
+    wal.update(Solr(core='hb2', data=[]))
+    logging.info('Updated the relations of %s records to %s' % (done, record_id))
+    return done
+
+def _relation_update(child, target):
+    '''Return an atomic update of the relation fields of a record that still embed an outdated copy of the target.'''
+    update = {}
+    for field in RELATIONS:
+        relations = []
+        changed = False
+        for value in child.get(field) or []:
+            relation = json.loads(value)
+            if relation.get('id') == target.get('id') and (relation.get('title') != target.get('title') or
+                                                           relation.get('pubtype') != target.get('pubtype')):
+                relation['title'] = target.get('title')
+                relation['pubtype'] = target.get('pubtype')
+                changed = True
+            relations.append(json.dumps(relation))
+        if changed:
+            update[field] = {'set': relations}
+    if update:
+        update['id'] = child.get('id')
+    return update
+
+def _flash_pending_write():
+    flash(gettext('The record has been saved. It will show up in searches as soon as the index is available again.'),
+          'info')
+
+def _start_relation_propagation(olddata, data):
+    '''Start updating the records referencing a record in the background if its title or pubtype changed.'''
+    if olddata.get('title') != data.get('title') or olddata.get('pubtype') != data.get('pubtype'):
+        jobs.enqueue('propagate_relations', data.get('id'), user=current_user.id)
+        flash(gettext('The records related to this one are being updated in the background.'), 'info')
 
 @app.route('/orcid2name/<orcid_id>')
 @login_required
@@ -743,8 +902,13 @@ def orcid2name(orcid_id=''):
         #logging.info(bio.get('orcid-profile').get('orcid-bio').get('personal-details').get('family-name'))
     return jsonify({'name': '%s, %s' % (bio.get('orcid-profile').get('orcid-bio').get('personal-details').get('family-name').get('value'), bio.get('orcid-profile').get('orcid-bio').get('personal-details').get('given-names').get('value'))})
 
+# The fields shown per record on the dashboard, see dashboard.html and resultlist_record.html
+DASHBOARD_FIELDS = ('id', 'pubtype', 'title', 'person', 'institution', 'circa', 'fdate', 'editorial_status', 'locked',
+                    'recordCreationDate', 'recordChangeDate', 'owner', 'deskman', '_version_')
+
 @app.route('/dashboard')
 @login_required
+@admission.limit('interactive')
 def dashboard():
     page = int(request.args.get('page', 1))
     mystart = 0
@@ -784,8 +948,13 @@ def dashboard():
                 'field': 'deskman'
             },
     }
-    dashboard_solr = Solr(start=(page - 1) * 10, query=query, sort='recordCreationDate asc', json_facet=DASHBOARD_FACETS, fquery=filterquery)
+    sorting = 'recordCreationDate asc'
+    cursor_key = _cursor_key('dashboard', query, filterquery, sorting)
+    dashboard_solr = Solr(start=(page - 1) * 10, query=query, sort=sorting, json_facet=DASHBOARD_FACETS,
+                          fquery=filterquery, cursor=_cursor_for_page(cursor_key, page), fields=list(DASHBOARD_FIELDS),
+                          compact=True)
     dashboard_solr.request()
+    _remember_cursor(cursor_key, page + 1, dashboard_solr.next_cursor)
 
     num_found = dashboard_solr.count()
     pagination = ''
@@ -801,7 +970,7 @@ def dashboard():
     return render_template('dashboard.html', records=dashboard_solr.results, facet_data=dashboard_solr.facets,
                            header=lazy_gettext('Dashboard'), site=theme(request.access_route), offset=mystart - 1,
                            query=query, filterquery=filterquery, pagination=pagination, now=datetime.datetime.now(),
-                           target='dashboard', del_redirect='dashboard'
+                           target='dashboard', del_redirect='dashboard', locale=get_locale().replace('_', '-')
                            )
 
 @app.route('/make_admin/<user_id>')
@@ -809,7 +978,7 @@ def dashboard():
 def make_admin(user_id=''):
     if user_id:
         ma_solr = Solr(core='hb2_users', data=[{'id': user_id, 'role': {'set': 'admin'}}])
-        ma_solr.update()
+        wal.update(ma_solr)
         flash(gettext('%s upgraded to admin!' % user_id), 'success')
         return redirect(url_for('index'))
     else:
@@ -833,7 +1002,7 @@ def superadmin():
                                 search_msg=lazy_gettext('Showing {start} to {end} of {found} {record_name}'))
     mystart = 1 + (pagination.page - 1) * pagination.per_page
 
-    solr_dumps = Solr(core='hb2_users', query='id:*.json', facet='false', rows=10000)
+    solr_dumps = Solr(core='hb2_users', query='id:*.json', facet='false', rows=10000, fields=DUMP_MANIFEST_FIELDS)
     solr_dumps.request()
     num_found = solr_dumps.count()
     form = FileUploadForm()
@@ -847,7 +1016,8 @@ def superadmin():
 def unlock(record_id=''):
     if record_id:
         unlock_solr = Solr(core='hb2', data=[{'id': record_id, 'locked': {'set': 'false'}}])
-        unlock_solr.update()
+        wal.update(unlock_solr)
+        _forget_doc('hb2', record_id)
 
     return redirect(url_for('superadmin'))
 
@@ -908,6 +1078,7 @@ def containers():
     return 'poop'
 
 @app.route('/organisations')
+@admission.limit('interactive')
 def orgas():
     page = int(request.args.get('page', 1))
     mystart = 0
@@ -915,7 +1086,9 @@ def orgas():
     filterquery = request.values.getlist('filter')
 
     orgas_solr = Solr(query=query, start=(page - 1) * 10, core='organisation',
-                      json_facet={'destatis_id': {'type': 'term', 'field': 'destatis_id'}}, fquery=filterquery)
+                      json_facet={'destatis_id': {'type': 'term', 'field': 'destatis_id'}}, fquery=filterquery,
+                      fields=['id', 'account', 'parent_id', 'parent_label', 'pref_label', 'created', 'changed'],
+                      compact=True)
     orgas_solr.request()
 
     num_found = orgas_solr.count()
@@ -934,33 +1107,16 @@ def orgas():
                            offset=mystart - 1, query=query, filterquery=filterquery, pagination=pagination, now=datetime.datetime.now())
 
 def _orga2solr(form):
-    tmp = {}
-    wtf_json = json.dumps(form.data)
-    tmp.setdefault('wtf_json', wtf_json)
-    for field in form.data:
-        if field == 'orga_id':
-            tmp.setdefault('id', form.data.get(field))
-        elif field == 'alt_label':
-            for alt_label in form.data.get(field):
-                tmp.setdefault('alt_label', []).append(alt_label.data.strip())
-        elif field == 'created':
-            tmp.setdefault('created', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        elif field == 'changed':
-            tmp.setdefault('changed', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        elif field == 'destatis':
-            for destatis in form.data.get(field):
-                if destatis.get('destatis_label'):
-                    tmp.setdefault('destatis_label', []).append(destatis.get('destatis_label').strip())
-                if destatis.get('destatis_id'):
-                    tmp.setdefault('destatis_id', []).append(destatis.get('destatis_id').strip())
-        else:
-            if form.data.get(field):
-                tmp.setdefault(field, form.data.get(field))
+    data = form.data
+    tmp = {'wtf_json': encode_wtf_json(data)}
+    solr_mapping.orga2solr(data, tmp)
     orga_solr = Solr(core='organisation', data=[tmp])
-    orga_solr.update()
+    wal.update(orga_solr)
+    _forget_doc('organisation', data.get('id'))
 
 @app.route('/create/organisation', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def new_orga():
     form = OrgaAdminForm()
 
@@ -974,91 +1130,16 @@ def new_orga():
     return render_template('linear_form.html', header=lazy_gettext('New Organisation'), site=theme(request.access_route), form=form, action='create', pubtype='organisation')
 
 def _person2solr(form):
-    tmp = {}
-    for field in form.data:
-        # logging.info('%s => %s' % (field, form.data.get(field)))
-        if field == 'name' or field == 'former_name':
-            tmp.setdefault('name', []).append(form.data.get(field).strip())
-        # elif field == 'gnd':
-        #     if form.data.get(field):
-        #         form.id.data = form.data.get(field).strip()
-        #         tmp.setdefault('id', form.data.get(field).strip())
-        #         tmp.setdefault('gnd', form.data.get(field).strip())
-        #     else:
-        #         if not form.data.get('id'):
-        #             theid = str(uuid.uuid4())
-        #             tmp.setdefault('id', theid)
-        #             form.id.data = theid
-        elif field == 'gnd':
-            tmp.setdefault('gnd', form.data.get(field).strip())
-        elif field == 'id':
-            tmp.setdefault('id', form.data.get(field))
-        elif field == 'created':
-            tmp.setdefault('created', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        elif field == 'changed':
-            tmp.setdefault('changed', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-        elif field == 'research_interest':
-            for research_interest in form.data.get(field):
-                tmp.setdefault('research_interest', []).append(research_interest.strip())
-        elif field == 'url':
-            for url in form.data.get(field):
-                tmp.setdefault('url', []).append(url.get('label').strip())
-        elif field == 'membership':
-            for membership in form.data.get(field):
-                if membership.get('label'):
-                    tmp.setdefault('membership', []).append(membership.get('label').strip())
-        elif field == 'award':
-            for award in form.data.get(field):
-                if award.get('label'):
-                    tmp.setdefault('award', []).append(award.get('label').strip())
-        elif field == 'project':
-            for project in form.data.get(field):
-                if project.get('label'):
-                    tmp.setdefault('project', []).append(project.get('label').strip())
-                if project.get('project_id') and project.get('label'):
-                    tmp.setdefault('project_id', []).append(
-                        '%s#%s' % (project.get('project_id').strip(), project.get('label').strip()))
-                if project.get('project_type'):
-                    tmp.setdefault('project_type', []).append(project.get('project_type'))
-        elif field == 'thesis':
-            for thesis in form.data.get(field):
-                if thesis.get('label'):
-                    tmp.setdefault('thesis', []).append(thesis.get('label').strip())
-        elif field == 'affiliation':
-            for affiliation in form.data.get(field):
-                if affiliation.get('label'):
-                    tmp.setdefault('affiliation', []).append(affiliation.get('label').strip())
-        elif field == 'cv':
-            for cv in form.data.get(field):
-                if cv.get('label'):
-                    tmp.setdefault('cv', []).append(cv.get('label').strip())
-        elif field == 'editor':
-            for editor in form.data.get(field):
-                if editor.get('label'):
-                    tmp.setdefault('editor', []).append(editor.get('label').strip())
-                if editor.get('issn'):
-                    tmp.setdefault('editor_issn', []).append(editor.get('issn'))
-                if editor.get('zdbid'):
-                    tmp.setdefault('editor_zdbid', []).append(editor.get('zdbid'))
-        elif field == 'reviewer':
-            for reviewer in form.data.get(field):
-                if reviewer.get('label'):
-                    tmp.setdefault('reviewer', []).append(reviewer.get('label').strip())
-                if reviewer.get('issn'):
-                    tmp.setdefault('reviewer_issn', []).append(reviewer.get('issn'))
-                if reviewer.get('zdbid'):
-                    tmp.setdefault('reviewer_zdbid', []).append(reviewer.get('zdbid'))
-        else:
-            if form.data.get(field):
-                # logging.info('%s => %s' % (field, form.data.get(field)))
-                tmp.setdefault(field, form.data.get(field))
-    wtf_json = json.dumps(form.data)
-    tmp.setdefault('wtf_json', wtf_json)
+    data = form.data
+    tmp = solr_mapping.person2solr(data)
+    tmp.setdefault('wtf_json', encode_wtf_json(data))
     person_solr = Solr(core='person', data=[tmp])
-    person_solr.update()
+    wal.update(person_solr)
+    _forget_doc('person', data.get('id'))
 
 @app.route('/create/person', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def new_person():
     form = PersonAdminForm()
     if form.validate_on_submit():
@@ -1091,37 +1172,19 @@ def new_by_search():
 
 @app.route('/create/<pubtype>', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def new_record(pubtype='ArticleJournal'):
     form = PUBTYPE2FORM.get(pubtype)()
 
     if request.is_xhr:
         logging.info(request.form)
         form.formdata = request.form
-        # Do we have any data already?
-        if not form.title.data:
-            solr_data = {}
-            wtf = json.dumps(form.data)
-            solr_data.setdefault('wtf_json', wtf)
-            for field in form.data:
-                # logging.info('%s => %s' % (field, form.data.get(field)))
-                if field == 'id':
-                    solr_data.setdefault('id', form.data.get(field).strip())
-                if field == 'created':
-                    solr_data.setdefault('recordCreationDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-                if field == 'changed':
-                    solr_data.setdefault('recordChangeDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
-                if field == 'owner':
-                    solr_data.setdefault('owner', form.data.get(field).strip())
-                if field == 'pubtype':
-                    solr_data.setdefault('pubtype', form.data.get(field).strip())
-                if field == 'editorial_status':
-                    solr_data.setdefault('editorial_status', form.data.get(field).strip())
-            #solr = requests.post('http://127.0.0.1:8983/solr/hb2/update/json?commit=true', data=json.dumps([solr_data]),
-                                 #headers={'Content-type': 'application/json'})
-            record_solr = Solr(core='hb2', data=[solr_data])
-            record_solr.update()
-        else:
-            _record2solr(form, action='create')
+        try:
+            # Autosaves only replace the draft, it is written to Solr by _write_draft()
+            drafts.save(current_user.id, form.id.data, pubtype, form.data)
+        except RedisError as e:
+            logging.error(e)
+            _draft2solr(form)
         return jsonify({'status': 200})
 
     for person in form.person:
@@ -1140,7 +1203,9 @@ def new_record(pubtype='ArticleJournal'):
             flash_errors(form)
             return render_template('tabbed_form.html', form=form, header=lazy_gettext('New Record'),
                                    site=theme(request.access_route), action='create', pubtype=pubtype)
-        _record2solr(form, action='create')
+        if _record2solr(form, action='create') is None:
+            _flash_pending_write()
+        _discard_draft(form.id.data)
         return redirect(url_for('dashboard'))
 
     if request.args.get('subtype'):
@@ -1159,58 +1224,198 @@ def new_record(pubtype='ArticleJournal'):
 
     return render_template('tabbed_form.html', form=form, header=lazy_gettext('New Record'), site=theme(request.access_route), pubtype=pubtype, action='create', record_id=form.id.data)
 
-@app.route('/retrieve/<pubtype>/<record_id>')
-def show_record(pubtype, record_id=''):
-    show_record_solr = Solr( query='id:%s' % record_id)
-    show_record_solr.request()
+def _draft2solr(form):
+    '''Write an autosaved record. Records without a title yet are stored with their administrative fields only.'''
+    if not form.title.data:
+        _stamp_changed(form)
+        solr_data = {}
+        wtf = encode_wtf_json(form.data)
+        solr_data.setdefault('wtf_json', wtf)
+        for field in form.data:
+            # logging.info('%s => %s' % (field, form.data.get(field)))
+            if field == 'id':
+                solr_data.setdefault('id', form.data.get(field).strip())
+            if field == 'created':
+                solr_data.setdefault('recordCreationDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
+            if field == 'changed':
+                solr_data.setdefault('recordChangeDate', form.data.get(field).strip().replace(' ', 'T') + 'Z')
+            if field == 'owner':
+                solr_data.setdefault('owner', form.data.get(field).strip())
+            if field == 'pubtype':
+                solr_data.setdefault('pubtype', form.data.get(field).strip())
+            if field == 'editorial_status':
+                solr_data.setdefault('editorial_status', form.data.get(field).strip())
+        #solr = requests.post('http://127.0.0.1:8983/solr/hb2/update/json?commit=true', data=json.dumps([solr_data]),
+                             #headers={'Content-type': 'application/json'})
+        record_solr = Solr(core='hb2', data=[solr_data])
+        wal.update(record_solr)
+    else:
+        _record2solr(form, action='create')
+
+def _write_draft(draft):
+    form = PUBTYPE2FORM.get(draft.get('pubtype')).from_json(draft.get('data'))
+    _draft2solr(form)
+
+def _get_draft(record_id):
+    try:
+        return drafts.get(current_user.id, record_id)
+    except RedisError as e:
+        logging.error(e)
+
+def _discard_draft(record_id):
+    try:
+        drafts.discard(current_user.id, record_id)
+    except RedisError as e:
+        logging.error(e)
+
+def _read_doc(core, doc_id, version=None):
+    '''The Solr doc shown on a detail page, from the local record store if there is one.'''
+    if record_store is not None:
+        doc = record_store.read(core, doc_id, version=version)
+    else:
+        doc_solr = Solr(core=core, query='id:%s' % doc_id, facet='false')
+        doc_solr.request()
+        doc = doc_solr.results[0] if doc_solr.results else None
+    if doc is None:
+        abort(404)
+    return doc
+
+def _forget_doc(core, doc_id):
+    # Written documents are read from Solr again, the changes feed may not see the change, e.g. of the lock flag
+    if record_store is not None:
+        try:
+            record_store.delete(core, doc_id)
+        except sqlite3.Error as e:
+            logging.error(e)
 
-    is_part_of = show_record_solr.results[0].get('is_part_of')
-    has_part = show_record_solr.results[0].get('has_part')
-    other_version = show_record_solr.results[0].get('other_version')
+# Pages rendered by an older release of the templates or the code must not validate
+PAGE_RELEASE = str(max([os.path.getmtime(__file__)] + [
+    os.path.getmtime(os.path.join(root, name)) for root, dirs, names
+    in os.walk(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')) for name in names]))
 
-    thedata = json.loads(show_record_solr.results[0].get('wtf_json'))
-    locked = show_record_solr.results[0].get('locked')
+def _page_validators(core, doc_id, idfield='id'):
+    '''
+    The ETag of a detail page from the _version_ of its doc, asked from Solr with a query for just this field. The
+    ETag also depends on everything else the page shows, i.e. the locale and the user. There is no Last-Modified, as
+    the change date of the doc alone would validate the page for another locale or user. Returns None if Solr is
+    unavailable, but the doc can be read from the record store.
+    '''
+    fields = ['id', '_version_']
+    if record_store is None and not request.if_none_match:
+        # The page has to be rendered anyway, so read the whole doc at once
+        fields = []
+    check_solr = Solr(core=core, query='%s:%s' % (idfield, doc_id), facet='false', rows=1, fields=fields)
+    try:
+        check_solr.request()
+    except SolrUnavailable:
+        if record_store is None or idfield != 'id':
+            raise
+        return None
+    if not check_solr.results:
+        abort(404)
+    doc = check_solr.results[0]
+    user = current_user.id if current_user.is_authenticated else ''
+    role = current_user.role if current_user.is_authenticated else ''
+    etag = hashlib.sha1(('%s|%s|%s|%s|%s|%s|%s' % (PAGE_RELEASE, core, doc.get('id'), doc.get('_version_'),
+                                                   get_locale(), user, role)).encode('utf-8')).hexdigest()
+    return {'id': doc.get('id'), 'version': doc.get('_version_'), 'etag': etag,
+            'doc': None if fields else doc}
+
+def _page_doc(core, doc_id, validators):
+    if validators is None:
+        return _read_doc(core, doc_id)
+    return validators.get('doc') or _read_doc(core, validators.get('id'), version=validators.get('version'))
+
+def _with_validators(resp, validators):
+    '''Add the validators and Cache-Control to a detail page. Only pages of anonymous users may be cached publicly.'''
+    resp.vary.add('Cookie')
+    if validators is None:
+        resp.cache_control.no_cache = True
+        return resp
+    resp.set_etag(validators.get('etag'))
+    if current_user.is_authenticated:
+        resp.cache_control.private = True
+        resp.cache_control.no_cache = True
+    else:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = secrets.PAGE_MAX_AGE
+    return resp
+
+def _not_modified(validators):
+    '''Return a 304 response if the client has the current version of the page.'''
+    # Pending flash messages are shown on the next page, so it has to be rendered
+    if validators is None or session.get('_flashes'):
+        return None
+    if is_resource_modified(request.environ, etag=validators.get('etag')):
+        return None
+    return _with_validators(make_response('', 304), validators)
+
+@app.route('/retrieve/<pubtype>/<record_id>')
+@admission.limit('interactive')
+def show_record(pubtype, record_id=''):
+    validators = _page_validators('hb2', record_id)
+    not_modified = _not_modified(validators)
+    if not_modified is not None:
+        return not_modified
+    doc = _page_doc('hb2', record_id, validators)
+
+    is_part_of = doc.get('is_part_of')
+    has_part = doc.get('has_part')
+    other_version = doc.get('other_version')
+
+    thedata = get_wtf_json(doc)
+    locked = doc.get('locked')
     form = PUBTYPE2FORM.get(pubtype).from_json(thedata)
 
-    return render_template('record.html', record=form, header=form.data.get('title'), site=theme(request.access_route),
-                           action='retrieve', record_id=record_id, del_redirect='dashboard', pubtype=pubtype,
-                           role_map=ROLE_MAP, lang_map=LANGUAGE_MAP, pubtype_map=PUBTYPE2TEXT, subtype_map=SUBTYPE2TEXT,
-                           locked=locked, is_part_of=is_part_of, has_part=has_part, other_version=other_version
-    )
+    return _with_validators(make_response(render_template(
+        'record.html', record=form, header=form.data.get('title'), site=theme(request.access_route),
+        action='retrieve', record_id=record_id, del_redirect='dashboard', pubtype=pubtype, role_map=ROLE_MAP,
+        lang_map=LANGUAGE_MAP, pubtype_map=PUBTYPE2TEXT, subtype_map=SUBTYPE2TEXT, locked=locked,
+        is_part_of=is_part_of, has_part=has_part, other_version=other_version)), validators)
 
 @app.route('/retrieve/person/<person_id>')
+@admission.limit('interactive')
 def show_person(person_id=''):
     idfield = 'id'
     if GND_RE.match(person_id):
         idfield = 'gnd'
-    show_person_solr = Solr( query='%s:%s' % (idfield, person_id), core='person', facet='false')
-    show_person_solr.request()
+    validators = _page_validators('person', person_id, idfield=idfield)
+    not_modified = _not_modified(validators)
+    if not_modified is not None:
+        return not_modified
+    doc = _page_doc('person', person_id, validators)
 
-    thedata = json.loads(show_person_solr.results[0].get('wtf_json'))
+    thedata = get_wtf_json(doc)
     form = PersonAdminForm.from_json(thedata)
 
-    return render_template('record.html', record=form, header=form.data.get('name'), site=theme(request.access_route),
-                           action='retrieve', record_id=person_id, pubtype='person', del_redirect='persons')
+    return _with_validators(make_response(render_template(
+        'record.html', record=form, header=form.data.get('name'), site=theme(request.access_route),
+        action='retrieve', record_id=person_id, pubtype='person', del_redirect='persons')), validators)
 
 @app.route('/retrieve/organisation/<orga_id>')
+@admission.limit('interactive')
 def show_orga(orga_id=''):
-    show_orga_solr = Solr( query='id:%s' % orga_id, core='organisation', facet='false')
-    show_orga_solr.request()
+    validators = _page_validators('organisation', orga_id)
+    not_modified = _not_modified(validators)
+    if not_modified is not None:
+        return not_modified
+    doc = _page_doc('organisation', orga_id, validators)
 
-    thedata = json.loads(show_orga_solr.results[0].get('wtf_json'))
+    thedata = get_wtf_json(doc)
     form = OrgaAdminForm.from_json(thedata)
 
-    return render_template('record.html', record=form, header=form.data.get('pref_label'),
-                           site=theme(request.access_route), action='retrieve', record_id=orga_id,
-                           pubtype='organisation', del_redirect='organisations')
+    return _with_validators(make_response(render_template(
+        'record.html', record=form, header=form.data.get('pref_label'), site=theme(request.access_route),
+        action='retrieve', record_id=orga_id, pubtype='organisation', del_redirect='organisations')), validators)
 
 @app.route('/update/organisation/<orga_id>', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def edit_orga(orga_id=''):
     edit_orga_solr = Solr(query='id:%s' % orga_id, core='organisation')
     edit_orga_solr.request()
 
-    thedata = json.loads(edit_orga_solr.results[0].get('wtf_json'))
+    thedata = get_wtf_json(edit_orga_solr.results[0])
 
     if request.method == 'POST':
         form = OrgaAdminForm()
@@ -1232,6 +1437,7 @@ def edit_orga(orga_id=''):
 
 @app.route('/update/person/<person_id>', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def edit_person(person_id=''):
     idfield = 'id'
     if GND_RE.match(person_id):
@@ -1239,7 +1445,7 @@ def edit_person(person_id=''):
     edit_person_solr = Solr(query='%s:%s' % (idfield, person_id), core='person', facet='false')
     edit_person_solr.request()
 
-    thedata = json.loads(edit_person_solr.results[0].get('wtf_json'))
+    thedata = get_wtf_json(edit_person_solr.results[0])
 
     if request.method == 'POST':
         form = PersonAdminForm()
@@ -1263,32 +1469,51 @@ def edit_person(person_id=''):
 @app.route('/delete/person/<person_id>')
 def delete_person(person_id=''):
     delete_person_solr = Solr(core='person', del_id=person_id)
-    delete_person_solr.delete()
+    wal.delete(delete_person_solr)
+    _forget_doc('person', person_id)
 
     return jsonify({'deleted': True})
 
 @app.route('/delete/organisation/<orga_id>')
 def delete_orga(orga_id=''):
     delete_orga_solr = Solr(core='organisation', del_id=orga_id)
-    delete_orga_solr.delete()
+    wal.delete(delete_orga_solr)
+    _forget_doc('organisation', orga_id)
 
     return jsonify({'deleted': True})
 
 @app.route('/update/<pubtype>/<record_id>', methods=['GET', 'POST'])
 @login_required
+@admission.limit('edit')
 def edit_record(record_id='', pubtype=''):
-    lock_record_solr = Solr(core='hb2', data=[{'id': record_id, 'locked': {'set': 'true'}}])
-    lock_record_solr.update()
+    if not secrets.SOLR_OPTIMISTIC_LOCKING:
+        lock_record_solr = Solr(core='hb2', data=[{'id': record_id, 'locked': {'set': 'true'}}])
+        wal.update(lock_record_solr)
+        _forget_doc('hb2', record_id)
 
     edit_record_solr = Solr(core='hb2', query='id:%s' % record_id)
     edit_record_solr.request()
 
-    thedata = json.loads(edit_record_solr.results[0].get('wtf_json'))
+    draft = _get_draft(record_id)
+    stored = None
+    solr_version = None
+    if edit_record_solr.results or draft is None:
+        stored = get_wtf_json(edit_record_solr.results[0])
+        solr_version = edit_record_solr.results[0].get('_version_')
+    # Records autosaved, but not yet written to Solr only exist as a draft
+    thedata = stored or draft.get('data')
+    # The version the editor opened the form with. It is kept when the form is shown again, e.g. with errors.
+    form_version = solr_version
 
     if request.method == 'POST':
         form = PUBTYPE2FORM.get(pubtype)()
+        form_version = request.form.get('solr_version')
     elif request.method == 'GET':
-        form = PUBTYPE2FORM.get(pubtype).from_json(thedata)
+        if draft is not None:
+            form = PUBTYPE2FORM.get(pubtype).from_json(draft.get('data'))
+            flash(gettext('Your unsaved changes to this record have been restored.'), 'info')
+        else:
+            form = PUBTYPE2FORM.get(pubtype).from_json(thedata)
 
     if current_user.role == 'admin':
         form.pubtype.choices = ADMIN_PUBTYPES
@@ -1309,18 +1534,42 @@ def edit_record(record_id='', pubtype=''):
             flash_errors(form)
             return render_template('tabbed_form.html', form=form,
                                    header=lazy_gettext('Edit: %(title)s', title=form.data.get('title')),
-                                   site=theme(request.access_route), action='update', pubtype=pubtype)
-        _record2solr(form, action='update')
-        unlock_record_solr = Solr(core='hb2', data=[{'id': record_id, 'locked': {'set': 'false'}}])
-        unlock_record_solr.update()
-        return redirect(url_for('dashboard'))
+                                   site=theme(request.access_route), action='update', pubtype=pubtype,
+                                   record_id=record_id, solr_version=form_version)
+        _discard_draft(record_id)
+        if not secrets.SOLR_OPTIMISTIC_LOCKING:
+            resp = _record2solr(form, action='update', olddata=stored)
+            unlock_record_solr = Solr(core='hb2', data=[{'id': record_id, 'locked': {'set': 'false'}}])
+            wal.update(unlock_record_solr)
+            _forget_doc('hb2', record_id)
+            if resp is None:
+                _flash_pending_write()
+            else:
+                _start_relation_propagation(thedata, form.data)
+            return redirect(url_for('dashboard'))
+        resp = _record2solr(form, action='update', version=form_version, olddata=stored)
+        if resp is None:
+            _flash_pending_write()
+            return redirect(url_for('dashboard'))
+        if resp.status_code != 409:
+            if resp.status_code == 200:
+                _start_relation_propagation(thedata, form.data)
+            return redirect(url_for('dashboard'))
+        # Somebody else saved the record since it was opened. Show the differences to the stored version and let
+        # the editor save again on top of it.
+        flash(Markup(lazy_gettext('<p><i class="fa fa-exclamation-triangle fa-3x"></i> <h3>This record has been changed by someone else in the meantime. The stored version differs in the following fields</h3></p>')) + _diff_struct(thedata, form.data), 'error')
+        return render_template('tabbed_form.html', form=form,
+                               header=lazy_gettext('Edit: %(title)s', title=form.data.get('title')),
+                               site=theme(request.access_route), action='update', pubtype=pubtype,
+                               record_id=record_id, solr_version=solr_version)
 
     form.changed.data = datetime.datetime.now()
     form.deskman.data = current_user.email
 
     return render_template('tabbed_form.html', form=form, header=lazy_gettext('Edit: %(title)s',
                                                                          title=form.data.get('title')),
-                           site=theme(request.access_route), action='update', pubtype=pubtype, record_id=record_id)
+                           site=theme(request.access_route), action='update', pubtype=pubtype, record_id=record_id,
+                           solr_version=form_version)
 
 @app.route('/delete/<record_id>')
 def delete_record(record_id=''):
@@ -1333,24 +1582,76 @@ def delete_record(record_id=''):
     #return redirect(url_for('dashboard'))
 
     delete_record_solr = Solr(core='hb2', del_id=record_id)
-    delete_record_solr.delete()
+    wal.delete(delete_record_solr)
+    _forget_doc('hb2', record_id)
+    _record_tombstone(record_id)
 
     return jsonify({'deleted': True})
 
+TOMBSTONES_KEY = 'hb2:tombstones'
+
+def _record_tombstone(record_id):
+    '''Remember a deleted record for the next differential dump and forget those older than SOLR_TOMBSTONE_DAYS.'''
+    try:
+        redis_store.rpush(TOMBSTONES_KEY, json.dumps({'id': record_id, 'deleted': solr_dump.timestamp()}))
+        expired = datetime.datetime.now() - datetime.timedelta(days=secrets.SOLR_TOMBSTONE_DAYS)
+        while True:
+            oldest = redis_store.lindex(TOMBSTONES_KEY, 0)
+            if oldest is None or solr_dump.parse_timestamp(json.loads(oldest).get('deleted')) >= expired:
+                break
+            redis_store.lpop(TOMBSTONES_KEY)
+    except RedisError as e:
+        logging.error(e)
+
+def _tombstones_since(since):
+    since = solr_dump.parse_timestamp(since)
+    record_ids = []
+    for tombstone in redis_store.lrange(TOMBSTONES_KEY, 0, -1):
+        tombstone = json.loads(tombstone)
+        if solr_dump.parse_timestamp(tombstone.get('deleted')) >= since:
+            record_ids.append(tombstone.get('id'))
+    return record_ids
+
 @app.route('/add/file')
 def add_file():
     pass
 
 @app.route(('/consolidate/persons'))
+@login_required
 def consolidate_persons():
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    return _job_started(jobs.enqueue('consolidate_persons', user=current_user.id))
+
+@app.route('/consolidate/persons/<job_id>')
+@login_required
+def consolidate_persons_results(job_id=''):
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    job = jobs.status(job_id)
+    if job is None or job.get('name') != 'consolidate_persons':
+        flash(gettext('There is no such job!'), 'error')
+        return redirect(url_for('dashboard'))
+    if job.get('status') != 'finished':
+        flash(gettext('The job is %(status)s, please try again later.', status=job.get('status')), 'info')
+        return redirect(url_for('dashboard'))
+    return render_template('consolidate_persons.html', results=job.get('result'), header=lazy_gettext('Consolidate Persons'), site=theme(request.access_route))
+
+@jobs.task('consolidate_persons', priority='bulk')
+def _consolidate_persons(job):
     # TODO: Deduplizierung nach Nachname, 1. Buchsctabe des Vornamens
     # TODO: Vorname und Nachname sind gleich, aber GNDs unterschiedlich => Ist das ueberhaupt ein TODO?
     # TODO: Nachname ist gleich und wenn Vorname in den Daten nur ein Buchstabe oder wenn echter Vorname, dann die ersten beiden Buchstaben vergleichen
     results = {}
-    new_titles = Solr(fquery=['editorial_status:new'], facet='false', rows=2000000, fields=['fperson', 'pnd', 'id', 'title', 'pubtype'])
+    new_titles = Solr(fquery=['editorial_status:new'], facet='false', rows=2000000, fields=['fperson', 'pnd', 'id', 'title', 'pubtype'],
+                      compact=True, bulk=True)
     new_titles.request()
 
-    for doc in new_titles.results:
+    for count, doc in enumerate(new_titles.results):
+        if count % 100 == 0:
+            job.progress(count, len(new_titles.results))
         logging.info(doc)
         if doc.get('pnd'):
             for gnd in doc.get('pnd'):
@@ -1430,7 +1731,8 @@ def consolidate_persons():
             # except IndexError:
             #     logging.info('2) %s not found' % person)
             pass
-    return render_template('consolidate_persons.html', results=results, header=lazy_gettext('Consolidate Persons'), site=theme(request.access_route))
+    job.progress(len(new_titles.results), len(new_titles.results))
+    return results
 ########################################################################################################################
 class UserNotFoundError(Exception):
     pass
@@ -1575,6 +1877,11 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    try:
+        # Write the drafts of this session, or leave them to the idle flush if another process is writing drafts
+        drafts.flush(_write_draft, user=current_user.id)
+    except RedisError as e:
+        logging.error(e)
     logout_user()
     return redirect('/')
 
@@ -1602,22 +1909,94 @@ def unlock_message(message):
 
 @socketio.on('connect', namespace='/hb2')
 def connect():
+    if current_user.is_authenticated and current_user.role == 'admin':
+        # Only admins are told about jobs
+        join_room('admins')
     emit('my response', {'data': 'connected'})
 
 @app.route('/export/solr_dump')
+@login_required
 def export_solr_dump():
     '''
-    Export the wtf_json field of every doc in the index to a new document in the users core and to the user's local file
-    system. Uses the current user's ID and a timestamp as the document ID and file name.
+    Queue an export of the wtf_json field of every doc in the index to a new dump. With the ID of a dump in the
+    'since' parameter, only the changes since that dump are exported.
+    '''
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    return _job_started(jobs.enqueue('export_dump', current_user.id, request.args.get('since', ''),
+                                     user=current_user.id))
+
+@jobs.task('export_dump', priority='bulk')
+def _export_dump(job, user_id, since=''):
     '''
-    filename = '%s_%s.json' % (current_user.id, int(time.time()))
-    export_solr = Solr(export_field='wtf_json')
-    export_docs = export_solr.export()
-    target_solr = Solr(core='hb2_users', data=[{'id': filename, 'dump': json.dumps(export_docs)}])
+    Export the wtf_json field of every doc in the index to a new dump and store its manifest in the users core. Uses
+    the user's ID and a timestamp as the document ID and file name.
+
+    With the ID of a dump as since, only the records changed since that dump was created and the IDs of the records
+    deleted since then are exported.
+    '''
+    filename = '%s_%s.json' % (user_id, int(time.time()))
+    fquery = []
+    extra = {}
+    if since:
+        base_solr = Solr(core='hb2_users', query='id:%s' % since, facet='false', fields=DUMP_MANIFEST_FIELDS)
+        base_solr.request()
+        created = _manifest_value(base_solr.results[0], 'created') if base_solr.results else None
+        if not created:
+            raise ValueError('There is no dump %s to export the changes from!' % since)
+        # Changes stamped shortly before the base dump was created may have become visible only after it read them
+        created = solr_dump.timestamp(solr_dump.parse_timestamp(created) -
+                                      datetime.timedelta(seconds=secrets.SOLR_DUMP_DELTA_OVERLAP))
+        fquery = ['recordChangeDate:[%s TO *]' % created]
+        extra = {'base': since, 'since': created}
+        # Taken before the export starts, so nothing deleted while it runs is missed by the next delta
+        tombstones = _tombstones_since(created)
+    count_solr = Solr(fquery=fquery, rows=0, facet='false')
+    count_solr.request()
+    total = count_solr.count()
+    export_solr = Solr(export_field='wtf_json', fquery=fquery, rows=secrets.SOLR_EXPORT_ROWS)
+
+    def records():
+        for count, record in enumerate(export_solr.export_iter(), 1):
+            if count % secrets.SOLR_EXPORT_ROWS == 0:
+                job.progress(count, total)
+            yield record
+
+    try:
+        manifest = solr_dump.write_dump(filename, records(), **extra)
+    except BaseException:
+        solr_dump.delete_dump(filename)
+        raise
+    if since:
+        solr_dump.write_tombstones(filename, tombstones)
+        manifest['deleted_count'] = len(tombstones)
+    target_solr = Solr(core='hb2_users', data=[manifest])
     target_solr.update()
+    job.progress(manifest.get('record_count'), manifest.get('record_count'), dump=filename)
+
+    return manifest
+
+def _download_dump(filename):
+    return Response(stream_with_context(solr_dump.dump_as_json(filename)), mimetype='application/json',
+                    headers={'Content-Disposition': 'attachment; filename=%s' % filename})
+
+@app.route('/export/solr_dump/<filename>')
+@login_required
+def download_solr_dump(filename=''):
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    return _download_dump(filename)
 
-    return send_file(BytesIO(str.encode(json.dumps(export_docs))), attachment_filename=filename, as_attachment=True,
-                     cache_timeout=1, add_etags=True)
+DUMP_MANIFEST_FIELDS = ['id', 'created', 'record_count', 'byte_size', 'checksum', 'base', 'since', 'deleted_count']
+
+def _manifest_value(manifest, field):
+    # Schemaless cores index new fields as multivalued
+    value = manifest.get(field)
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value
 
 @app.route('/import/solr_dumps')
 def import_solr_dumps():
@@ -1625,7 +2004,8 @@ def import_solr_dumps():
     Import Solr dumps either from the users core or from the local file system.
     '''
     page = int(request.args.get('page', 1))
-    solr_dumps = Solr(core='hb2_users', query='id:*.json', facet='false', start=(page - 1) * 10)
+    solr_dumps = Solr(core='hb2_users', query='id:*.json', facet='false', start=(page - 1) * 10,
+                      fields=DUMP_MANIFEST_FIELDS)
     solr_dumps.request()
     num_found = solr_dumps.count()
     pagination = Pagination(page=page, total=num_found, found=num_found, bs_version=3, search=True,
@@ -1636,43 +2016,271 @@ def import_solr_dumps():
     return render_template('solr_dumps.html', records=solr_dumps.results, offset=mystart - 1, pagination=pagination,
                            header=lazy_gettext('Import Dump'), del_redirect='import/solr_dumps', form=form)
 
-def _import_data(doc):
-    form = PUBTYPE2FORM.get(doc.get('pubtype')).from_json(doc)
-    return _record2solr_doc(form, action='')
+def _import_data(doc, resolver=None):
+    if secrets.SOLR_IMPORT_VALIDATE:
+        form_class = PUBTYPE2FORM.get(doc.get('pubtype'))
+        if form_class is None:
+            raise ValueError('Unknown pubtype %s' % doc.get('pubtype'))
+        errors = solr_mapping.validate(doc, solr_mapping.schema(form_class))
+        if errors:
+            raise ValueError('; '.join(errors[:5]))
+    return _record2solr_doc(doc, action='', resolver=resolver)
+
+_import_resolver = None
+
+def _import_worker_init():
+    # Building forms and flashing warnings needs a request context
+    app.test_request_context().push()
+    # Every worker remembers the relation targets it has seen for the rest of the import
+    global _import_resolver
+    _import_resolver = RelationResolver()
+
+def _import_chunk(chunk):
+    resolver = _import_resolver or RelationResolver()
+    # Relations within the chunk are resolved from the chunk itself, all others with as few queries as possible
+    resolver.add(chunk)
+    try:
+        resolver.prefetch(myid for doc in chunk for myid in _relation_ids(doc))
+    except Exception as e:
+        logging.error('Prefetching relations failed: %s' % e)
+    solr_docs = []
+    errors = []
+    for doc in chunk:
+        try:
+            solr_docs.append(_import_data(doc, resolver=resolver))
+        except Exception as e:
+            errors.append('%s: %s' % (doc.get('id'), e))
+    return solr_docs, errors
+
+def _chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _post_chunk(solr_docs):
+    resp = Solr(core='hb2', data=solr_docs, commit='false').update()
+    if resp.status_code != 200:
+        raise Exception('HTTP %s: %s' % (resp.status_code, resp.text[:200]))
+    return len(solr_docs)
+
+def _import_records(records, progress=None):
+    '''
+    Convert wtf_json records to Solr documents on a process pool and index them in chunks of SOLR_IMPORT_CHUNK_SIZE
+    with at most SOLR_IMPORT_MAX_INFLIGHT updates in flight. Records are consumed lazily and Solr commits once at
+    the end. Failed records and chunks are reported instead of aborting the import. progress is called with the
+    report whenever a chunk has been indexed.
+    '''
+    report = {'records': 0, 'failed_records': 0, 'failed_chunks': 0, 'errors': []}
+    started = time.time()
+    pool = Pool(secrets.SOLR_IMPORT_PROCESSES, initializer=_import_worker_init)
+    poster = ThreadPoolExecutor(max_workers=secrets.SOLR_IMPORT_MAX_INFLIGHT)
+    conversions = deque()
+    postings = deque()
+
+    def finish_posting():
+        chunk_no, size, future = postings.popleft()
+        try:
+            report['records'] += future.result()
+        except Exception as e:
+            logging.error('Import of chunk %s failed: %s' % (chunk_no, e))
+            report['failed_chunks'] += 1
+            report['failed_records'] += size
+            report['errors'].append('Chunk %s: %s' % (chunk_no, e))
+        if progress is not None:
+            progress(report)
+
+    def post_conversion():
+        chunk_no, result = conversions.popleft()
+        solr_docs, errors = result.get()
+        report['failed_records'] += len(errors)
+        report['errors'].extend(errors)
+        if solr_docs:
+            if len(postings) >= secrets.SOLR_IMPORT_MAX_INFLIGHT:
+                finish_posting()
+            postings.append((chunk_no, len(solr_docs), poster.submit(_post_chunk, solr_docs)))
+
+    try:
+        for chunk_no, chunk in enumerate(_chunks(records, secrets.SOLR_IMPORT_CHUNK_SIZE)):
+            conversions.append((chunk_no, pool.apply_async(_import_chunk, (chunk,))))
+            if len(conversions) >= 2 * secrets.SOLR_IMPORT_PROCESSES:
+                post_conversion()
+        while conversions:
+            post_conversion()
+        while postings:
+            finish_posting()
+    finally:
+        pool.close()
+        pool.join()
+        poster.shutdown()
+    Solr(core='hb2', data=[]).update()
+
+    report['seconds'] = round(time.time() - started, 1)
+    report['docs_per_second'] = round(report.get('records') / max(report.get('seconds'), 0.1), 1)
+    logging.info('Imported %(records)s records in %(seconds)ss (%(docs_per_second)s docs/s), %(failed_records)s failed' % report)
+    return report
 
 @app.route('/import/solr_dump/<filename>', methods=['GET', 'POST'])
+@login_required
 def import_solr_dump(filename=''):
-    thedata = ''
-    solr_data = []
+    '''Queue the import of a dump and the differential dumps it is based on, or of an uploaded dump.'''
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
     if request.method == 'GET':
         if filename:
-            import_solr = Solr(core='hb2_users', query='id:%s' % filename, facet='false')
-            import_solr.request()
-
-            thedata = json.loads(import_solr.results[0].get('dump')[0])
+            return _job_started(jobs.enqueue('import_dump', filename, user=current_user.id))
     elif request.method == 'POST':
         form = FileUploadForm()
         if form.validate_on_submit():
-            thedata = json.loads(form.file.data.stream.read())
+            # The worker reads the upload from the dump directory and removes it when done
+            os.makedirs(secrets.SOLR_DUMP_DIR, exist_ok=True)
+            upload = 'upload_%s.json' % uuid.uuid4()
+            form.file.data.save(os.path.join(secrets.SOLR_DUMP_DIR, upload))
+            return _job_started(jobs.enqueue('import_dump', '', upload, user=current_user.id))
+
+    return redirect('dashboard')
 
-    #pool = Pool(4)
-    #solr_data.append(pool.map(_import_data, thedata))
-    for mydata in thedata:
-        solr_data.append(_import_data(mydata))
-    import_solr = Solr(core='hb2', data=solr_data)
-    import_solr.update()
+@jobs.task('import_dump', priority='bulk')
+def _import_dump(job, filename, upload=''):
+    '''
+    Import a dump, applying a differential dump on top of its base, which may be a differential dump itself, or an
+    uploaded dump. Returns the import report of every dump.
+    '''
+    reports = []
 
-    flash('%s records imported!' % len(thedata), 'success')
+    def progress(offset, total):
+        return lambda report: job.progress(offset + report.get('records') + report.get('failed_records'), total)
 
-    return redirect('dashboard')
+    if upload:
+        path = os.path.join(secrets.SOLR_DUMP_DIR, os.path.basename(upload))
+        try:
+            with open(path, 'rb') as dump:
+                report = _import_records(solr_dump.iter_records(dump), progress=progress(0, None))
+        except Exception as e:
+            # Keep the upload for the retries
+            if isinstance(e, JobCancelled) or job.last_attempt:
+                os.remove(path)
+            raise
+        os.remove(path)
+        report['errors'] = report.get('errors')[:100]
+        return [report]
+
+    chain = _dump_chain(filename)
+    total = sum(int(_manifest_value(manifest, 'record_count') or 0) for manifest in chain) or None
+    done = 0
+    for manifest in chain:
+        if manifest.get('dump'):
+            # Dumps from before the segment files
+            thedata = solr_dump.iter_records(StringIO(manifest.get('dump')[0]))
+        else:
+            thedata = solr_dump.read_dump(manifest.get('id'))
+        report = _import_records(thedata, progress=progress(done, total))
+        done += report.get('records') + report.get('failed_records')
+        tombstones = solr_dump.read_tombstones(manifest.get('id')) if _manifest_value(manifest, 'base') else []
+        if tombstones:
+            Solr(core='hb2', del_id=tombstones).delete()
+        report['deleted'] = len(tombstones)
+        report['dump'] = manifest.get('id')
+        reports.append(report)
+    for report in reports:
+        report['errors'] = report.get('errors')[:100]
+    return reports
+
+def _dump_chain(filename):
+    '''Return the manifests from the full dump a dump is based on up to the dump itself.'''
+    chain = []
+    while filename:
+        if filename in [manifest.get('id') for manifest in chain]:
+            raise ValueError('Circular dump chain at %s' % filename)
+        dump_solr = Solr(core='hb2_users', query='id:%s' % filename, facet='false',
+                         fields=DUMP_MANIFEST_FIELDS + ['dump'])
+        dump_solr.request()
+        if not dump_solr.results:
+            raise ValueError('Missing dump %s' % filename)
+        chain.insert(0, dump_solr.results[0])
+        filename = _manifest_value(dump_solr.results[0], 'base')
+    return chain
 
 @app.route('/delete/solr_dump/<record_id>')
 def delete_dump(record_id=''):
     delete_record_solr = Solr(core='hb2_users', del_id=record_id)
     delete_record_solr.delete()
+    solr_dump.delete_dump(record_id)
 
     return jsonify({'deleted': True})
 
+@app.errorhandler(SolrUnavailable)
+def solr_unavailable(error):
+    logging.error(error)
+    return gettext('The index is currently unavailable! Please try again in a few moments.'), 503, \
+           {'Retry-After': secrets.SOLR_BREAKER_COOLDOWN}
+
+@app.route('/metrics')
+def metrics():
+    '''Counters of this worker process, e.g. how many Solr requests were saved by request coalescing.'''
+    return jsonify({'pid': os.getpid(), 'solr': solr_handler.stats(), 'jobs': {'queued': jobs.depth()},
+                    'wal': {'backlog': wal.depth(), 'dead_letters': wal.dead_letters()},
+                    'fragments': fragments.stats()})
+
+def _job_started(job_id):
+    '''Answer a request that queued a job with its ID, or for browsers, with a message and the superadmin board.'''
+    if request.is_xhr or request.accept_mimetypes.best == 'application/json':
+        resp = jsonify({'job': job_id, 'status': url_for('job_status', job_id=job_id)})
+        resp.status_code = 202
+        return resp
+    flash(gettext('The job %(job)s has been queued. Its progress is shown on the dashboard.', job=job_id), 'info')
+    return redirect(url_for('superadmin'))
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id=''):
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    job = jobs.status(job_id)
+    if job is None:
+        resp = jsonify({'error': 'unknown job'})
+        resp.status_code = 404
+        return resp
+    return jsonify(job)
+
+@app.route('/jobs/<job_id>/cancel')
+@login_required
+def cancel_job(job_id=''):
+    if current_user.role != 'admin':
+        flash(gettext('For Admins ONLY!!!'))
+        return redirect(url_for('homepage'))
+    return jsonify({'cancelled': jobs.cancel(job_id)})
+
+def _relay_jobs():
+    # Job workers publish every change of a job, pass them on to the admins' browsers. Results are fetched by route.
+    jobs.listen(lambda job: socketio.emit('job', dict((key, value) for key, value in job.items() if key != 'result'),
+                                          namespace='/hb2', room='admins'))
+
+@app.before_first_request
+def _start_job_relay():
+    threading.Thread(target=_relay_jobs, daemon=True).start()
+
+@app.before_first_request
+def _start_wal_replay():
+    # Every web process replays the write-ahead log, the lock in Redis lets only one of them send at a time
+    threading.Thread(target=wal.run, daemon=True).start()
+
+@app.before_first_request
+def _start_draft_flush():
+    # Drafts are turned into forms, which need a request context
+    threading.Thread(target=drafts.run, args=(_write_draft, app.test_request_context), daemon=True).start()
+
+@app.before_first_request
+def _start_record_store_feed():
+    if record_store is not None:
+        threading.Thread(target=record_store.run, daemon=True).start()
+
 @app.route('/retrieve/related_items/<relation>/<record_ids>')
 def show_related_item(relation='', record_ids=''):
     query = query='{!terms f=id}%s' % record_ids
@@ -0,0 +1,227 @@
+# The MIT License
+#
+#  Copyright 2015 UB Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+import logging
+import time
+import traceback
+import uuid
+
+import simplejson as json
+from redis import RedisError
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+QUEUE_KEY = 'hb2:jobs:queue'
+EVENTS_CHANNEL = 'hb2:jobs:events'
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    '''Handle passed to a running job function to report progress and to check for cancellation.'''
+    def __init__(self, queue, data):
+        self.queue = queue
+        self.data = data
+        self.id = data.get('id')
+
+    @property
+    def last_attempt(self):
+        '''Whether the job is not retried if this attempt fails.'''
+        return self.data.get('attempts') > secrets.JOB_RETRIES
+
+    def progress(self, done, total=None, **info):
+        '''Update the progress counters. Raises JobCancelled if the job was cancelled in the meantime.'''
+        self.data['done'] = done
+        if total is not None:
+            self.data['total'] = total
+        self.data.setdefault('info', {}).update(info)
+        self.queue._save(self.data)
+        if self.queue.cancel_requested(self.id):
+            raise JobCancelled()
+
+
+class JobQueue(object):
+    '''
+    A FIFO queue of jobs on Redis. Job functions are registered by name with task() and run by worker processes
+    started with work(). Every job is kept as a JSON document with its status, progress counters, result or error
+    for JOB_TTL seconds; status changes are published on the EVENTS_CHANNEL. Failed jobs are retried JOB_RETRIES
+    times after JOB_RETRY_DELAY seconds.
+    '''
+    def __init__(self, redis):
+        self.redis = redis
+        self.tasks = {}
+        self.priorities = {}
+
+    def _key(self, job_id):
+        return 'hb2:job:%s' % job_id
+
+    def _save(self, data):
+        data['updated'] = time.time()
+        self.redis.set(self._key(data.get('id')), json.dumps(data), ex=secrets.JOB_TTL)
+        self.redis.publish(EVENTS_CHANNEL, json.dumps(data))
+
+    def task(self, name, priority=None):
+        '''
+        Decorator registering a job function. The function is called with the Job handle and the job arguments. Jobs
+        with a priority class only run when the admission control of the worker admits them.
+        '''
+        def decorator(func):
+            self.tasks[name] = func
+            self.priorities[name] = priority
+            return func
+        return decorator
+
+    def enqueue(self, name, *args, **kwargs):
+        '''Queue a job and return its ID. The user the job runs for can be given as user.'''
+        if name not in self.tasks:
+            raise ValueError('Unknown job %s' % name)
+        data = {
+            'id': str(uuid.uuid4()),
+            'name': name,
+            'args': list(args),
+            'user': kwargs.get('user'),
+            'status': 'queued',
+            'created': time.time(),
+            'attempts': 0,
+            'done': 0,
+            'total': 0,
+        }
+        self._save(data)
+        self.redis.rpush(QUEUE_KEY, data.get('id'))
+        return data.get('id')
+
+    def status(self, job_id):
+        data = self.redis.get(self._key(job_id))
+        if data is None:
+            return None
+        return json.loads(data)
+
+    def cancel(self, job_id):
+        '''Ask for a job to be cancelled. Running jobs stop at their next progress report.'''
+        data = self.status(job_id)
+        if data is None or data.get('status') not in ('queued', 'running'):
+            return False
+        self.redis.set('%s:cancel' % self._key(job_id), 1, ex=secrets.JOB_TTL)
+        return True
+
+    def cancel_requested(self, job_id):
+        return bool(self.redis.get('%s:cancel' % self._key(job_id)))
+
+    def depth(self):
+        return self.redis.llen(QUEUE_KEY)
+
+    def work(self, context=None, admission=None):
+        '''
+        Run jobs forever. Each job runs within the context manager returned by context(), if given. Jobs not admitted
+        by the AdmissionControl admission are retried after ADMISSION_RETRY_AFTER seconds.
+        '''
+        logging.info('Job worker started for %s' % ', '.join(sorted(self.tasks)))
+        while True:
+            try:
+                item = self.redis.blpop(QUEUE_KEY, timeout=5)
+            except RedisError as e:
+                logging.error(e)
+                time.sleep(5)
+                continue
+            if item is None:
+                continue
+            job_id = item[1].decode('utf-8') if isinstance(item[1], bytes) else item[1]
+            data = self.status(job_id)
+            if data is None:
+                continue
+            if data.get('not_before', 0) > time.time():
+                # Waiting for a retry, put it back at the end of the queue
+                self.redis.rpush(QUEUE_KEY, job_id)
+                time.sleep(min(1, data.get('not_before') - time.time()))
+                continue
+            priority = self.priorities.get(data.get('name'))
+            if admission is not None and priority is not None:
+                try:
+                    admitted = admission.acquire(priority)
+                except RedisError as e:
+                    logging.error(e)
+                    priority = None
+                else:
+                    if not admitted:
+                        data['not_before'] = time.time() + secrets.ADMISSION_RETRY_AFTER
+                        self._save(data)
+                        self.redis.rpush(QUEUE_KEY, job_id)
+                        continue
+            try:
+                if context is None:
+                    self.run(data)
+                else:
+                    with context():
+                        self.run(data)
+            finally:
+                if admission is not None and priority is not None:
+                    try:
+                        admission.release(priority)
+                    except RedisError as e:
+                        logging.error(e)
+
+    def run(self, data):
+        job = Job(self, data)
+        if self.cancel_requested(job.id):
+            data['status'] = 'cancelled'
+            self._save(data)
+            return
+        data['status'] = 'running'
+        data['attempts'] += 1
+        data['started'] = time.time()
+        self._save(data)
+        try:
+            data['result'] = self.tasks.get(data.get('name'))(job, *data.get('args'))
+            data['status'] = 'finished'
+        except JobCancelled:
+            data['status'] = 'cancelled'
+        except Exception as e:
+            logging.error('Job %s (%s) failed: %s' % (job.id, data.get('name'), traceback.format_exc()))
+            data['error'] = str(e)
+            if data.get('attempts') <= secrets.JOB_RETRIES:
+                data['status'] = 'queued'
+                data['not_before'] = time.time() + secrets.JOB_RETRY_DELAY
+                self._save(data)
+                self.redis.rpush(QUEUE_KEY, job.id)
+                return
+            data['status'] = 'failed'
+        data['finished'] = time.time()
+        self._save(data)
+        logging.info('Job %s (%s) %s' % (job.id, data.get('name'), data.get('status')))
+
+    def listen(self, callback):
+        '''Call callback with every job published on the EVENTS_CHANNEL. Blocks, so run it in a thread.'''
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                pubsub.subscribe(EVENTS_CHANNEL)
+                for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        callback(json.loads(message.get('data')))
+            except RedisError as e:
+                logging.error(e)
+                time.sleep(5)
@@ -28,6 +28,8 @@ import logging
 import pprint
 import simplejson as json
 
+from solr_mapping import compile_mapping, first, APPEND, EACH, FIRST
+
 try:
     import site_secrets as secrets
 except ImportError:
@@ -204,29 +206,22 @@ def get_wtf_abstract(elems):
 
     return {'abstract': wtf_abstracts}
 
-def doi2index(elems):
-    doi = elems[0]
-    solr_doi = {}
-
-    solr_doi.setdefault('doi', doi)
-
-    # TODO: Handle all cases in which the DOI is the source for enrichment
-
-    return solr_doi
+def text(elem):
+    return elem.text
 
 try:
     CONVERTER_MAP = {
         "./m:abstract": {
             'wtf': get_wtf_abstract,
             'csl': lambda elems: {'abstract': elems[0].text},
-            'solr': lambda elems: {'ro_abstract': elems[0].text},
+            'solr': [('ro_abstract', text, FIRST)],
             'oai_dc': (oai_elements, 'abstract')
         },
         # "./m:accessCondition[@type='restriction on access']": lambda elem : {'': elem.text},
         # "./m:accessCondition[@type='use and reproduction']": lambda elem : {'': elem.text},
         "./m:classification[@authority='international patent classification']": {
             'wtf': lambda elems : {'bibliographic_ipc': elems[0].text} ,
-            'solr': lambda elems: {'number': elems[0].text},
+            'solr': [('number', first(text), APPEND)],
         },
         # "./m:extension": lambda elem : {'': elem.text},
         # "./m:extension/dcterms:bibliographicCitation": lambda elem : {'': elem.text},
@@ -255,56 +250,56 @@ try:
         "./m:genre[@valueURI='http://purl.org/info:eu-repo/semantics/studentThesis']": {'oai_dc': (oai_valueURI, 'type')},
         "./m:identifier[@displayLabel='Anmeldenummer']": {
             'wtf': lambda elems: {'application_number': [elem.text for elem in elems]},
-            'solr': lambda elems: {'number': [elem.text for elem in elems]},
+            'solr': [('number', text, EACH)],
         },
         "./m:identifier[@displayLabel='Veröffentlichungs-Nr.']": {
             'wtf': lambda elems: {'patent_number': elems[0].text},
-            'solr': lambda elems: {'number': elems[0].text},
+            'solr': [('number', first(text), APPEND)],
         },
         "./m:identifier[@type='doi']": {
             'wtf': lambda elems: {'DOI': elems[0].text},
             'csl': lambda elems: {'DOI': elems[0].text},
-            'solr': doi2index,
+            'solr': [('doi', text, FIRST)],
             'oai_dc': (oai_elements, 'identifier')
         },
         "./m:identifier[@type='isbn']": {
             'wtf': lambda elems: {'ISBN': [elem.text for elem in elems]},
             'csl': lambda elems: {'isbn': [elem.text for elem in elems]},
-            'solr': lambda elems: {'isbn': [elem.text for elem in elems], 'isxn': [elem.text for elem in elems]},
+            'solr': [('isbn', text, EACH), ('isxn', text, EACH)],
             'oai_dc': (oai_elements, 'identifier')
         },
         # "./m:identifier[@type='isi']": lambda elem : {'': elem.text},
         "./m:identifier[@type='issn']": {
             'wtf': lambda elems: {'ISSN': [elem.text for elem in elems]},
             'csl': lambda elems: {'issn': [elem.text for elem in elems]},
-            'solr': lambda elems: {'issn': [elem.text for elem in elems],'isxn': [elem.text for elem in elems]},
+            'solr': [('issn', text, EACH), ('isxn', text, EACH)],
             'oai_dc': (oai_elements, 'identifier')
         },
         "./m:identifier[@type='local' and @displayLabel='HT-ID']": {
             'wtf': lambda elems: {'hbz_id': elems[0].text},
-            'solr': lambda elems: {'hbz_id': elems[0].text},
+            'solr': [('hbz_id', text, FIRST)],
         },
         "./m:identifier[@type='pm']": {
             'wtf': lambda elems: {'PMID': elems[0].text},
-            'solr': lambda elems: {'pmid': elems[0].text},
+            'solr': [('pmid', text, FIRST)],
         },
         "./m:identifier[@type='standard number']": {
             'wtf': lambda elems: {'number': elems[0].text},
-            'solr': lambda elems: {'number': elems[0].text},
+            'solr': [('number', first(text), APPEND)],
         },
         "./m:identifier[@type='urn']": {
             'wtf': lambda elems: {'urn': elems[0].text},
-            'solr': lambda elems: {'urn': elems[0].text},
+            'solr': [('urn', text, FIRST)],
             'oai_dc': (oai_elements, 'identifier')
         },
         "./m:identifier[@type='zdb']": {
             'wtf': lambda elems: {'ZDBID': elems[0].text},
-            'solr': lambda elems: {'zdbid': elems[0].text},
+            'solr': [('zdbid', text, FIRST)],
         },
         "./m:language/m:languageTerm[@type='code' and @authority='iso639-2b']": {
             'wtf': lambda elems : {'language': [elem.text for elem in elems]},
             'csl': lambda elems : {'language': [elem.text for elem in elems]},
-            'solr': lambda elems : {'language': [elem.text for elem in elems]},
+            'solr': [('language', text, EACH)],
             'oai_dc': (oai_elements, 'language')
         },
         # "./m:location": lambda elem : {'': elem.text},
@@ -313,7 +308,7 @@ try:
         "./m:location/url": {
             'wtf': lambda elems: {'uri': elems[0].text},
             'csl': lambda elems: {'url': elems[0].text},
-            #'solr': lambda elems: {'publisher': elems[0].text},
+            #'solr': [('publisher', text, FIRST)],
             'oai_dc': (oai_elements, 'identifier')
         },
         # "./m:location/url[@displayLabel='Adresse im Internet']": lambda elem : {'': elem.text},
@@ -341,13 +336,13 @@ try:
         "./m:originInfo/m:place/m:placeTerm[@type='text']": {
             'wtf': lambda elems: {'publisher_place': elems[0].text},
             'csl': lambda elems: {'publisher_place': elems[0].text},
-            'solr': lambda elems: {'place': elems[0].text},
+            'solr': [('place', text, FIRST)],
             #'oai_dc': (oai_elements, 'publisher_place')
         },
         "./m:originInfo/m:publisher": {
             'wtf': lambda elems: {'publisher': elems[0].text},
             'csl': lambda elems: {'publisher': elems[0].text},
-            'solr': lambda elems: {'publisher': elems[0].text},
+            'solr': [('publisher', text, FIRST)],
             'oai_dc': (oai_elements, 'publisher')
         },
 
@@ -362,20 +357,20 @@ try:
         },
         "./m:physicalDescription/note": {
             'wtf': lambda elems: {'note': elems[0].text},
-            'solr': lambda elems: {'note': elems[0].text},
+            'solr': [('note', text, FIRST)],
         },
         "./m:recordInfo/m:recordChangeDate[@encoding='iso8601']": {
             'wtf': lambda elems: {'changed': elems[0].text},
-            'solr': lambda elems: {'changed': '%sT00:00:00Z' % elems[0].text},
+            'solr': [('changed', lambda elem: '%sT00:00:00Z' % elem.text, FIRST)],
         },
         "./m:recordInfo/m:recordCreationDate[@encoding='iso8601']": {
             'wtf': lambda elems: {'created': elems[0].text},
-            'solr': lambda elems: {'created': '%sT00:00:00Z' % elems[0].text},
+            'solr': [('created', lambda elem: '%sT00:00:00Z' % elem.text, FIRST)],
         },
         "./m:recordInfo/m:recordIdentifier": {
             'wtf': lambda elems: {'id': elems[0].text},
             'csl': lambda elems: {'id': elems[0].text},
-            'solr': lambda elems: {'id': elems[0].text},
+            'solr': [('id', text, FIRST)],
             'oai_dc': (oai_elements, 'identifier')
         },
         # "./m:relatedItem": lambda elem : {'': elem.text},
@@ -433,40 +428,40 @@ try:
         # "./m:relatedItem[@type='series']": lambda elem : {'': elem.text},
         "./m:subject[not(@authority)]/m:topic":  {
             'wtf': lambda elems: {'keyword': [elem.text for elem in elems]},
-            'solr': lambda elems: {'subject': [elem.text for elem in elems]},
+            'solr': [('subject', text, EACH)],
             'oai_dc': (oai_elements, 'subject')
         },
         "./m:subject[@authority='mesh']": {
             'wtf': get_wtf_subject,
-            'solr': lambda elems: {'mesh_terms': [SUBJECT_MAPS.get('mesh').get(elem.text) for elem in elems]},
+            'solr': [('mesh_terms', lambda elem: SUBJECT_MAPS.get('mesh').get(elem.text), EACH)],
             'oai_dc': (oai_elements, 'subject')
         },
         "./m:subject[@authority='stw']": {
             'wtf': get_wtf_subject,
-            'solr': lambda elems: {'stwterm_de': [SUBJECT_MAPS.get('stw').get(elem.text) for elem in elems]},
+            'solr': [('stwterm_de', lambda elem: SUBJECT_MAPS.get('stw').get(elem.text), EACH)],
             'oai_dc': (oai_elements, 'subject')
         },
         # "./m:subject[@authority='thesoz']": lambda elem : {'': elem.text},
         "./m:tableOfContents": {
             'wtf': get_wtf_tocs,
-            'solr': lambda elems: {'toc_text': [elem.text for elem in elems]},
+            'solr': [('toc_text', text, EACH)],
         },
         # "./m:tableOfContents[@xlink:href]/@xlink:href": lambda elem : {'table_of_contents': elem},
         "./m:titleInfo[not(@type)]/m:title": {
             'wtf': lambda elems: {'title': elems[0].text},
             'csl': lambda elems: {'title': elems[0].text} if not record.xpath("./m:titleInfo/m:subTitle", namespaces=NSMAP) else
                                 {'title': '%s : %s' % (elems[0].text, record.xpath("./m:titleInfo/m:subTitle", namespaces=NSMAP)[0].text)},
-            'solr': lambda elems: {'title': elems[0].text, 'exacttitle': elems[0].text, 'sorttitle': elems[0].text},
+            'solr': [('title', text, FIRST), ('exacttitle', text, FIRST), ('sorttitle', text, FIRST)],
             'oai_dc': (oai_elements, 'title') # TODO: Elegant solution for dealing with subtitles...
         },
         "./m:titleInfo/m:subTitle": {
             'wtf': lambda elems: {'subtitle': elems[0].text},
-            'solr': lambda elems: {'subtitle': elems[0].text},
+            'solr': [('subtitle', text, FIRST)],
         },
         # "./m:titleInfo[@displayLabel='Paragraph(en)']": lambda elem : {'': elem.text},
         "./m:titleInfo[@type='translated']/m:title": {
             'wtf': lambda elems: {'title_translated': elems[0].text},
-            'solr': lambda elems: {'title_translated': elems[0].text},
+            'solr': [('title_translated', text, FIRST)],
         },
         # "./m:titleInfo[@type='uniform']": lambda elem : {'': elem.text},
         # "./m:typeOfResource": lambda elem : {'': elem.text},
@@ -474,14 +469,18 @@ try:
 except IndexError:
     pass
 
+SOLR_MAPPING = compile_mapping(dict((xpath_expr, converters.get('solr'))
+                                    for xpath_expr, converters in CONVERTER_MAP.items() if converters.get('solr')))
+
 for event, record in mc:
     wtf = {}
     csl = {}
-    solr = {}
+    elements = {}
     oai_dc = etree.Element('%smetadata' % OAI_DC, nsmap=OAI_MAP)
     #print '%s => %s' % (event, etree.tostring(record))
     for xpath_expr in CONVERTER_MAP:
         elems = record.xpath(xpath_expr, namespaces=NSMAP)
+        elements[xpath_expr] = elems
         # if len(elems) == 1:
         #     logging.info(etree.tostring(elems[0]))
         #     try:
@@ -535,14 +534,6 @@ for event, record in mc:
             pass
         except IndexError:
             pass
-        try:
-            data = CONVERTER_MAP.get(xpath_expr).get('solr')(elems)
-            if len(list(data.values())) > 0:
-                solr.update(data)
-        except TypeError:
-            pass
-        except IndexError:
-            pass
 
         try:
             oai_dc.extend(CONVERTER_MAP.get(xpath_expr).get('oai_dc')[0](CONVERTER_MAP.get(xpath_expr).get('oai_dc')[1],
@@ -554,6 +545,8 @@ for event, record in mc:
             logging.info(record.xpath("./m:recordInfo/m:recordIdentifier", namespaces=NSMAP)[0].text)
             raise
 
+    solr = SOLR_MAPPING(elements)
+
     #logging.info('WTF %s' % wtf)
     pprint.pprint(wtf)
     #logging.info('OAI_DC %s' % etree.tostring(oai_dc))
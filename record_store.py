@@ -0,0 +1,187 @@
+# The MIT License
+#
+#  Copyright 2015 UB Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import simplejson as json
+
+from solr_handler import Solr, SolrUnavailable
+import solr_dump
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+# Solr fields kept per document, i.e. what the detail pages need
+FIELDS = ('id', 'wtf_json', 'locked', 'is_part_of', 'has_part', 'other_version', '_version_')
+# The field the changes feed follows in each core
+CHANGE_FIELDS = {
+    'hb2': 'recordChangeDate',
+    'person': 'changed',
+    'organisation': 'changed',
+}
+
+
+class RecordStore(object):
+    '''
+    A local SQLite copy of the Solr documents read by the detail pages, shared by the worker processes of a host.
+    Documents are added when they are first read from Solr and refreshed by a changes feed on the CHANGE_FIELDS of the
+    cores. Documents older than RECORD_STORE_MAX_AGE seconds are read from Solr again, but still served while Solr
+    is unavailable.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS docs (core TEXT, id TEXT, doc TEXT, fetched REAL, '
+                         'PRIMARY KEY (core, id))')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def _connection(self):
+        # SQLite connections must not be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            # Readers don't block the writer and vice versa
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, core, doc_id):
+        '''Return the stored document and the time it was read from Solr, or None.'''
+        row = self._connection().execute('SELECT doc, fetched FROM docs WHERE core = ? AND id = ?',
+                                         (core, doc_id)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, core, docs):
+        now = time.time()
+        rows = []
+        for doc in docs:
+            rows.append((core, doc.get('id'), json.dumps(dict((field, doc.get(field)) for field in FIELDS
+                                                              if field in doc)), now))
+        conn = self._connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO docs (core, id, doc, fetched) VALUES (?, ?, ?, ?)', rows)
+
+    def delete(self, core, doc_id):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM docs WHERE core = ? AND id = ?', (core, doc_id))
+
+    def read(self, core, doc_id, version=None):
+        '''
+        Return the Solr document with the ID, from the store if it is recent enough or has the given _version_,
+        otherwise from Solr. Returns None if there is no such document. Raises SolrUnavailable only if the document is
+        not stored at all.
+        '''
+        stored = self.get(core, doc_id)
+        if stored is not None:
+            if version is not None:
+                current = stored[0].get('_version_') == version
+            else:
+                current = time.time() - stored[1] < secrets.RECORD_STORE_MAX_AGE
+            if current:
+                return stored[0]
+        doc_solr = Solr(core=core, query='id:%s' % doc_id, facet='false', fields=list(FIELDS))
+        try:
+            doc_solr.request()
+        except SolrUnavailable as e:
+            if stored is None:
+                raise
+            logging.warning('Serving stored %s/%s: %s' % (core, doc_id, e))
+            return stored[0]
+        if not doc_solr.results:
+            self.delete(core, doc_id)
+            return None
+        self.put(core, doc_solr.results[:1])
+        return doc_solr.results[0]
+
+    def _meta(self, key):
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _lease(self, seconds):
+        '''Take the changes feed for seconds, so only one process of the host follows it.'''
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            owner, until = (self._meta('feed_lease') or '0 0').split()
+            if int(owner) != os.getpid() and float(until) > time.time():
+                conn.rollback()
+                return False
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                         ('feed_lease', '%s %s' % (os.getpid(), time.time() + seconds)))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return True
+
+    def follow(self, core):
+        '''Store the documents of the core changed since the last call. The first call only sets the mark.'''
+        key = 'since:%s' % core
+        since = self._meta(key)
+        started = solr_dump.timestamp()
+        count = 0
+        if since:
+            cursor = '*'
+            while True:
+                changes_solr = Solr(core=core, fquery=['%s:[%s TO *]' % (CHANGE_FIELDS.get(core), since)],
+                                    facet='false', fields=list(FIELDS), rows=secrets.RECORD_STORE_FEED_ROWS,
+                                    sort='id asc', cursor=cursor, bulk=True)
+                changes_solr.request()
+                self.put(core, changes_solr.results)
+                count += len(changes_solr.results)
+                if not changes_solr.results or changes_solr.next_cursor == cursor:
+                    break
+                cursor = changes_solr.next_cursor
+        conn = self._connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, started))
+        return count
+
+    def run(self):
+        '''Follow the changes of all cores every RECORD_STORE_FEED_INTERVAL seconds. Blocks, so run it in a thread.'''
+        while True:
+            try:
+                if self._lease(secrets.RECORD_STORE_FEED_INTERVAL * 2):
+                    for core in sorted(CHANGE_FIELDS):
+                        count = self.follow(core)
+                        if count:
+                            logging.info('Stored %s changed documents of %s' % (count, core))
+            except SolrUnavailable as e:
+                logging.error('Changes feed: %s' % e)
+            except sqlite3.Error as e:
+                logging.error('Record store: %s' % e)
+            time.sleep(secrets.RECORD_STORE_FEED_INTERVAL)
@@ -37,8 +37,69 @@ MODS_TEST_FILE = ''
 
 SOLR_HOST = '127.0.0.1'
 SOLR_PORT = '8983'
+# Replicas for reads as (host, port) tuples and the leader for updates and deletes. By default everything goes to
+# SOLR_HOST:SOLR_PORT.
+SOLR_READ_NODES = []
+SOLR_WRITE_NODE = None
+# Replicas whose average response time exceeds SOLR_SLOW_REQUEST seconds are ejected for SOLR_EJECT_TIME seconds,
+# but never the last available one.
+# Ejected and failing nodes are checked every SOLR_HEALTH_CHECK_INTERVAL seconds.
+SOLR_SLOW_REQUEST = 2.0
+SOLR_EJECT_TIME = 30
+SOLR_HEALTH_CHECK = '/solr/admin/info/system?wt=json'
+SOLR_HEALTH_CHECK_INTERVAL = 5
 SOLR_CORE = 'hb2'
 SOLR_EXPORT_FIELD = 'wtf_json'
+# Store wtf_json zlib compressed and base64 encoded. Both encodings can be read at any time
+SOLR_COMPRESS_WTF_JSON = False
+# Detect concurrent edits of a record by its _version_ instead of writing a lock flag when the edit form is opened
+SOLR_OPTIMISTIC_LOCKING = True
+# Save edited records as atomic updates of the changed fields. Only enable it if all fields of the hb2 core are stored
+# or have docValues (copyField targets excepted): Solr rebuilds the document from them and silently drops the others.
+SOLR_ATOMIC_UPDATES = False
+# Dump imports convert records on SOLR_IMPORT_PROCESSES processes and send them to Solr in chunks of
+# SOLR_IMPORT_CHUNK_SIZE documents with at most SOLR_IMPORT_MAX_INFLIGHT updates in flight
+SOLR_IMPORT_PROCESSES = 4
+SOLR_IMPORT_CHUNK_SIZE = 500
+SOLR_IMPORT_MAX_INFLIGHT = 2
+# Check imported records against the schema of their form before indexing them
+SOLR_IMPORT_VALIDATE = True
+# When a record is retitled, the records embedding its title are updated in batches of this size
+SOLR_PROPAGATION_BATCH_SIZE = 500
+# Updates and deletes are logged in Redis before they are sent to Solr and replayed in batches of SOLR_WAL_BATCH_SIZE
+# every SOLR_WAL_REPLAY_INTERVAL seconds while Solr is unavailable. Editors wait up to SOLR_WAL_WAIT seconds for their
+# write to be sent before it is reported as pending. The outcome of a write is kept SOLR_WAL_RESULT_TTL seconds for them.
+SOLR_WAL_BATCH_SIZE = 100
+SOLR_WAL_REPLAY_INTERVAL = 5
+SOLR_WAL_WAIT = 1
+SOLR_WAL_LOCK_TIMEOUT = 120
+SOLR_WAL_RESULT_TTL = 60
+# Autosaved new records are kept as drafts in Redis and written to Solr on save, on logout or after DRAFT_IDLE_TIMEOUT
+# seconds without changes. Idle drafts are looked for every DRAFT_FLUSH_INTERVAL seconds.
+DRAFT_IDLE_TIMEOUT = 600
+DRAFT_FLUSH_INTERVAL = 60
+DRAFT_TTL = 30 * 24 * 3600
+DRAFT_LOCK_TIMEOUT = 300
+# Optional: keep the documents shown on the detail pages in a local SQLite file (one per host) and read them from
+# there. Documents are read from Solr again after RECORD_STORE_MAX_AGE seconds, changes are followed every
+# RECORD_STORE_FEED_INTERVAL seconds.
+RECORD_STORE_PATH = ''
+RECORD_STORE_MAX_AGE = 3600
+RECORD_STORE_FEED_INTERVAL = 30
+RECORD_STORE_FEED_ROWS = 500
+# Rendered rows of result lists and the dashboard kept per process, by record _version_, locale and role. 0 disables.
+FRAGMENT_CACHE_SIZE = 10000
+# Seconds a front proxy may serve record, person and organisation pages of anonymous users without revalidating them
+PAGE_MAX_AGE = 60
+# Dumps are written as gzipped NDJSON segments of SOLR_DUMP_SEGMENT_SIZE records to a directory below SOLR_DUMP_DIR
+SOLR_DUMP_DIR = '/var/lib/hb2/dumps'
+SOLR_DUMP_SEGMENT_SIZE = 10000
+# Differential dumps also export the changes stamped up to this many seconds before their base dump was created
+SOLR_DUMP_DELTA_OVERLAP = 300
+# Exports page through the index SOLR_EXPORT_ROWS docs at a time. Deleted record IDs are kept for differential
+# dumps for SOLR_TOMBSTONE_DAYS
+SOLR_EXPORT_ROWS = 1000
+SOLR_TOMBSTONE_DAYS = 90
 SOLR_ROWS = '20'
 SOLR_FACETS = {
     'pubtype':
@@ -68,6 +129,54 @@ SOLR_FACETS = {
             'sort': 'index desc'
         },
 }
+# Facet counts for /search are cached per query and filter set. Entries older than SOLR_FACET_CACHE_TTL seconds are
+# still served, but refreshed in the background. Entries older than SOLR_FACET_CACHE_MAX_AGE seconds are dropped.
+SOLR_FACET_CACHE_TTL = 300
+SOLR_FACET_CACHE_MAX_AGE = 3600
+# Opt-in: page through /search and the dashboard with Solr's cursorMark instead of start/rows. The cursor marks of
+# visited pages are kept in Redis for SOLR_CURSOR_TTL seconds per query and sort order.
+SOLR_CURSOR_PAGINATION = False
+SOLR_CURSOR_TTL = 1800
+# Identical concurrent Solr queries are sent upstream only once. Other processes get the response shared via Redis
+# for SOLR_COALESCE_WINDOW milliseconds.
+SOLR_COALESCE = True
+SOLR_COALESCE_WINDOW = 500
+# Connect and read timeouts in seconds per kind of Solr request. Exports and other scans of the whole index are not
+# retried and don't count towards the circuit breaker.
+SOLR_TIMEOUTS = {
+    'read': (3.05, 10),
+    'write': (3.05, 60),
+    'export': (3.05, 120),
+}
+# Reads are retried SOLR_RETRIES times with jittered exponential backoff starting at SOLR_RETRY_BACKOFF seconds
+SOLR_RETRIES = 2
+SOLR_RETRY_BACKOFF = 0.1
+# Stop sending requests to a Solr node for SOLR_BREAKER_COOLDOWN seconds after SOLR_BREAKER_THRESHOLD failures in a row
+SOLR_BREAKER_THRESHOLD = 5
+SOLR_BREAKER_COOLDOWN = 30
+
+# Admission control for Solr-heavy routes: maximum concurrent requests per priority class over all workers. Searches
+# without query and filters are 'browse' requests. Bulk jobs are run by the job workers and only admitted while fewer
+# than ADMISSION_BULK_MAX_INTERACTIVE interactive requests are in flight, otherwise retried after ADMISSION_RETRY_AFTER.
+ADMISSION_LIMITS = {
+    'interactive': 64,
+    'browse': 32,
+    'edit': 32,
+    'bulk': 2,
+}
+ADMISSION_BULK_MAX_INTERACTIVE = 16
+ADMISSION_RETRY_AFTER = 30
+# Long running jobs are kept for JOB_TTL seconds and retried JOB_RETRIES times after JOB_RETRY_DELAY seconds
+JOB_TTL = 7 * 24 * 3600
+JOB_RETRIES = 2
+JOB_RETRY_DELAY = 30
+# Token buckets per user and per IP address for the classes of views: (requests per second, burst). Bulk jobs are
+# only limited by their concurrency.
+RATE_LIMITS = {
+    'interactive': (5, 50),
+    'browse': (2, 30),
+    'edit': (2, 30),
+}
 
 TRAC_URL = ''
 TRAC_USER = ''
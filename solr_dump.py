@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+import codecs
+import datetime
+import gzip
+import hashlib
+import os
+import shutil
+import simplejson as json
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+
+def iter_records(stream, chunk_size=65536):
+    '''
+    Yield the records of a dump one by one while reading it from a file-like object. The dump is either a JSON array
+    of records or newline delimited JSON. Only the record currently being parsed is held in memory.
+    '''
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8-sig')()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if in_array is None:
+                in_array = buf[pos] == '['
+                if in_array:
+                    pos += 1
+                    continue
+            if in_array and buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # The record is incomplete, read on unless the dump is broken
+                if eof:
+                    raise
+            else:
+                yield record
+                pos = end
+                continue
+        if eof:
+            return
+        data = stream.read(chunk_size)
+        eof = not data
+        if isinstance(data, bytes):
+            data = utf8.decode(data, final=eof)
+        buf = buf[pos:] + data
+        pos = 0
+
+
+# Dumps are stored below SOLR_DUMP_DIR, one directory per dump holding gzipped NDJSON segments of
+# SOLR_DUMP_SEGMENT_SIZE records. Solr only keeps a small manifest document per dump in the users core.
+
+def dump_path(name):
+    if not name or name != os.path.basename(name) or name.startswith('.'):
+        raise ValueError('Invalid dump name: %s' % name)
+    return os.path.join(secrets.SOLR_DUMP_DIR, name)
+
+
+def segments(name):
+    path = dump_path(name)
+    return [os.path.join(path, segment) for segment in sorted(os.listdir(path)) if segment.endswith('.ndjson.gz')]
+
+
+def timestamp(value=None):
+    '''Format a point in time like recordChangeDate, i.e. the local time with a trailing Z.'''
+    return (value or datetime.datetime.now()).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_timestamp(value):
+    '''Parse a timestamp as written by timestamp() or returned by Solr, to the second.'''
+    return datetime.datetime.strptime(value.rstrip('Z').split('.')[0], '%Y-%m-%dT%H:%M:%S')
+
+
+def write_dump(name, records, **manifest):
+    '''
+    Write records to the segments of a new dump and return its manifest with the number of records, the
+    compressed size in bytes and the SHA-256 checksum of the uncompressed NDJSON. Additional keyword arguments
+    are added to the manifest. The creation time is taken before the first record is read, so changes
+    written while this dump is being written are exported again by a later differential dump.
+    '''
+    created = timestamp()
+    path = dump_path(name)
+    os.makedirs(path)
+    checksum = hashlib.sha256()
+    record_count = 0
+    segment = None
+    try:
+        for record in records:
+            if record_count % secrets.SOLR_DUMP_SEGMENT_SIZE == 0:
+                if segment is not None:
+                    segment.close()
+                segment = gzip.open(os.path.join(path, '%05d.ndjson.gz' % (
+                    record_count // secrets.SOLR_DUMP_SEGMENT_SIZE)), 'wb')
+            line = ('%s\n' % json.dumps(record)).encode('utf-8')
+            checksum.update(line)
+            segment.write(line)
+            record_count += 1
+    finally:
+        if segment is not None:
+            segment.close()
+    manifest.update({
+        'id': name,
+        'created': created,
+        'record_count': record_count,
+        'byte_size': sum(os.path.getsize(segment) for segment in segments(name)),
+        'checksum': 'sha256:%s' % checksum.hexdigest(),
+    })
+    return manifest
+
+
+# Differential dumps only contain the records changed since their base dump plus a list of the IDs of the records
+# deleted since then. They are applied on top of their base, which may be a differential dump itself.
+
+def write_tombstones(name, record_ids):
+    with open(os.path.join(dump_path(name), 'tombstones.json'), 'w') as tombstones:
+        json.dump(record_ids, tombstones)
+
+
+def read_tombstones(name):
+    path = os.path.join(dump_path(name), 'tombstones.json')
+    if not os.path.isfile(path):
+        return []
+    with open(path) as tombstones:
+        return json.load(tombstones)
+
+
+def read_dump(name):
+    '''Yield the records of a dump segment by segment.'''
+    for segment in segments(name):
+        with gzip.open(segment, 'rb') as ndjson:
+            for record in iter_records(ndjson):
+                yield record
+
+
+def dump_as_json(name):
+    '''Yield a dump as a JSON array in pieces, e.g. for a streamed download.'''
+    yield '['
+    first = True
+    for segment in segments(name):
+        with gzip.open(segment, 'rt', encoding='utf-8') as ndjson:
+            for line in ndjson:
+                if not first:
+                    yield ',\n'
+                yield line.rstrip('\n')
+                first = False
+    yield ']'
+
+
+def delete_dump(name):
+    path = dump_path(name)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
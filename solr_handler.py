@@ -23,6 +23,15 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #  THE SOFTWARE.
 
+import re
+import time
+import datetime
+import zlib
+import base64
+import random
+import hashlib
+import threading
+import uuid
 import urllib
 import requests
 from werkzeug import iri_to_uri
@@ -39,19 +48,471 @@ logging.basicConfig (level=logging.INFO,
     datefmt='%a, %d %b %Y %H:%M:%S',
 )
 
+# wtf_json is optionally stored zlib compressed and base64 encoded behind this prefix, see SOLR_COMPRESS_WTF_JSON
+WTF_JSON_PREFIX = 'zlib:'
+
+
+def encode_wtf_json(data):
+    text = json.dumps(data)
+    if not secrets.SOLR_COMPRESS_WTF_JSON:
+        return text
+    return WTF_JSON_PREFIX + base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+
+
+def decode_wtf_json(value):
+    '''Decode a JSON string stored by encode_wtf_json(), compressed or not.'''
+    if value.startswith(WTF_JSON_PREFIX):
+        value = zlib.decompress(base64.b64decode(value[len(WTF_JSON_PREFIX):])).decode('utf-8')
+    return json.loads(value)
+
+
+def get_wtf_json(doc, field='wtf_json'):
+    '''
+    Return the decoded wtf_json of a Solr doc. Results keep the stored string, so it is only decompressed and parsed
+    where it is actually used.
+    '''
+    value = doc.get(field)
+    if value is None:
+        return None
+    return decode_wtf_json(value)
+
+
+class ResultRow(object):
+    '''
+    A Solr doc of a query with a fixed field list. Each field is a slot, so a row takes a fraction of the memory of
+    the dict, which matters for result sets of hundreds of thousands of docs. Rows can be read like the dicts, by
+    attribute, item or get(). Missing fields are left unset, so templates see them as undefined, as with dicts. Dates and JSON are parsed on first use by parsed_date() and
+    parsed_json() and kept.
+    '''
+    __slots__ = ('_parsed',)
+    _fields = ()
+
+    def __init__(self, doc):
+        for field in self._fields:
+            value = doc.get(field)
+            if value is not None:
+                setattr(self, field, value)
+        self._parsed = None
+
+    def get(self, field, default=None):
+        if field not in self._fields:
+            return default
+        return getattr(self, field, default)
+
+    def __getitem__(self, field):
+        if field not in self._fields:
+            raise KeyError(field)
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def _parse(self, field, parse):
+        if self._parsed is None:
+            self._parsed = {}
+        if field not in self._parsed:
+            value = self.get(field)
+            self._parsed[field] = parse(value) if value is not None else None
+        return self._parsed[field]
+
+    def parsed_date(self, field):
+        return self._parse(field, parse_date)
+
+    def parsed_json(self, field='wtf_json'):
+        return self._parse(field, decode_wtf_json)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self._fields if hasattr(self, field))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.as_dict())
+
+
+_row_types = {}
+
+
+def row_type(fields):
+    '''Return the ResultRow class for a field list. Names that are no identifiers, e.g. [elevated], are left out.'''
+    key = tuple(fields)
+    if key not in _row_types:
+        slots = tuple(field for field in fields if field.isidentifier() and not hasattr(ResultRow, field))
+        _row_types[key] = type('ResultRow', (ResultRow,), {'__slots__': slots, '_fields': slots})
+    return _row_types[key]
+
+
+def parse_date(value):
+    '''
+    Parse a date as stored in wtf_json ('2016-02-01 10:12:13.123456') or returned by Solr
+    ('2016-02-01T10:12:13.123Z', without fraction if it is 0). Positions are sliced directly, strptime is only used
+    for anything else.
+    '''
+    if len(value) >= 19 and value[4] == '-' and value[7] == '-' and value[10] in ' T' and value[13] == ':' \
+            and value[16] == ':':
+        fraction = value[20:].rstrip('Z')
+        try:
+            return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]),
+                                     int(value[14:16]), int(value[17:19]), int(fraction.ljust(6, '0')[:6] or 0))
+        except ValueError:
+            pass
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    except ValueError:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class SolrUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Fail fast after SOLR_BREAKER_THRESHOLD consecutive failures of a Solr node. After SOLR_BREAKER_COOLDOWN seconds
+    one trial request is let through (half open), its outcome closes or reopens the breaker.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.time() - self.opened >= secrets.SOLR_BREAKER_COOLDOWN:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= secrets.SOLR_BREAKER_THRESHOLD:
+                if self.state != 'open':
+                    logging.error('Circuit breaker for Solr at %s opened' % self.name)
+                self.state = 'open'
+                self.opened = time.time()
+
+
+class Node(object):
+    '''
+    A Solr node with its circuit breaker, the number of requests currently in flight and an exponentially weighted
+    average of its response times. Slow nodes are ejected for SOLR_EJECT_TIME seconds.
+    '''
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.name = '%s:%s' % (host, port)
+        self.breaker = CircuitBreaker(self.name)
+        self.outstanding = 0
+        self.latency = 0.0
+        self.ejected_until = 0.0
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return 'http://%s%s' % (self.name, path)
+
+    def available(self):
+        if time.time() < self.ejected_until:
+            return False
+        return self.breaker.state == 'closed' or time.time() - self.breaker.opened >= secrets.SOLR_BREAKER_COOLDOWN
+
+    def started(self):
+        with self.lock:
+            self.outstanding += 1
+        return time.time()
+
+    def finished(self, started):
+        with self.lock:
+            self.outstanding -= 1
+            self.latency = 0.8 * self.latency + 0.2 * (time.time() - started)
+            return self.latency
+
+    def eject(self):
+        logging.error('Ejecting Solr node %s (average response time %.2fs)' % (self.name, self.latency))
+        self.ejected_until = time.time() + secrets.SOLR_EJECT_TIME
+        self.latency = 0.0
+        _start_health_checks()
+
+
+class NodePool(object):
+    '''
+    Pick the available node with the least outstanding requests, healthier and faster nodes win ties. If all nodes
+    are ejected, those with a closed breaker are picked, a slow node is better than none.
+    '''
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.lock = threading.Lock()
+
+    def pick(self, exclude=()):
+        candidates = [node for node in self.nodes if node.available()]
+        if not candidates:
+            candidates = [node for node in self.nodes if node.breaker.state == 'closed']
+        if not candidates:
+            raise SolrUnavailable('No Solr node available')
+        others = [node for node in candidates if node not in exclude]
+        if others:
+            candidates = others
+        random.shuffle(candidates)
+        return min(candidates, key=lambda node: (node.outstanding, node.breaker.failures, node.latency))
+
+    def eject(self, node):
+        '''Eject a slow node, unless it is the last available one.'''
+        with self.lock:
+            if any(other.available() for other in self.nodes if other is not node):
+                node.eject()
+
+
+_nodes = {}
+_nodes_lock = threading.Lock()
+
+
+def get_node(host, port):
+    with _nodes_lock:
+        name = '%s:%s' % (host, port)
+        if name not in _nodes:
+            _nodes[name] = Node(host, port)
+        return _nodes.get(name)
+
+
+# Reads (including exports) are balanced over the replicas, updates and deletes go to the leader
+_read_pool = NodePool([get_node(host, port) for host, port in
+                       secrets.SOLR_READ_NODES or [(secrets.SOLR_HOST, secrets.SOLR_PORT)]])
+_leader = get_node(*(secrets.SOLR_WRITE_NODE or (secrets.SOLR_HOST, secrets.SOLR_PORT)))
+_health_checker = None
+
+
+def _check_health():
+    while True:
+        time.sleep(secrets.SOLR_HEALTH_CHECK_INTERVAL)
+        with _nodes_lock:
+            nodes = list(_nodes.values())
+        for node in nodes:
+            if node.available() and node.breaker.state == 'closed':
+                continue
+            try:
+                healthy = requests.get(node.url(secrets.SOLR_HEALTH_CHECK),
+                                       timeout=secrets.SOLR_TIMEOUTS.get('read')).status_code == 200
+            except requests.exceptions.RequestException:
+                healthy = False
+            if healthy:
+                logging.info('Solr node %s is healthy again' % node.name)
+                node.ejected_until = 0.0
+                node.breaker.success()
+            elif time.time() >= node.ejected_until:
+                node.ejected_until = time.time() + secrets.SOLR_EJECT_TIME
+
+
+def _start_health_checks():
+    global _health_checker
+    with _nodes_lock:
+        if _health_checker is None:
+            _health_checker = threading.Thread(target=_check_health, daemon=True)
+            _health_checker.start()
+
+
+def call(operation, method, path, node=None, **kwargs):
+    '''
+    Send a request to Solr with the connect/read timeouts configured for the operation ('read', 'write' or
+    'export'). Writes go to the leader, reads to the least busy replica unless a node is given. Reads are retried
+    on another replica with jittered exponential backoff. Connection errors, timeouts and 5xx responses of reads and
+    writes count as failures for the node's circuit breaker. Exports scan the whole index, so they are neither
+    retried nor subject to the breaker. Raises SolrUnavailable if no node could answer.
+    '''
+    retries = 0
+    if operation == 'read':
+        retries = secrets.SOLR_RETRIES
+    breaker = operation != 'export'
+    tried = []
+    error = None
+    for attempt in range(retries + 1):
+        target = node
+        if target is None:
+            if operation == 'write':
+                target = _leader
+            else:
+                target = _read_pool.pick(exclude=tried)
+        tried.append(target)
+        if breaker and not target.breaker.allow():
+            count_stat('breaker_rejected')
+            error = 'circuit breaker for %s is open' % target.name
+            if target is _leader or node is not None:
+                break
+            continue
+        error = None
+        started = target.started()
+        try:
+            resp = requests.request(method, target.url(path), timeout=secrets.SOLR_TIMEOUTS.get(operation), **kwargs)
+            if resp.status_code >= 500:
+                error = 'HTTP %s' % resp.status_code
+        except requests.exceptions.RequestException as e:
+            error = e
+        finally:
+            latency = target.finished(started)
+        if error is None:
+            if breaker:
+                target.breaker.success()
+            if operation == 'read' and node is None and latency > secrets.SOLR_SLOW_REQUEST:
+                # Requests pinned to a node don't eject it
+                _read_pool.eject(target)
+            return resp
+        if breaker:
+            target.breaker.failure()
+            if target.breaker.state == 'open':
+                _start_health_checks()
+        count_stat('%s_failures' % operation)
+        logging.error('Solr %s request to %s failed (attempt %s): %s' % (operation, target.name, attempt + 1, error))
+        if attempt < retries:
+            time.sleep(random.uniform(0, min(2.0, secrets.SOLR_RETRY_BACKOFF * 2 ** attempt)))
+    raise SolrUnavailable('Solr is unavailable: %s' % error)
+
+
+# Request coalescing (single-flight): identical concurrent reads wait for one upstream call and share its parsed
+# response. Within a process this uses an in-flight table, across processes a Redis lock if a connection has been
+# registered with set_redis(). The parsed responses are shared between callers and must be treated as read-only.
+_redis = None
+_flights = {}
+_flights_lock = threading.Lock()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def set_redis(connection):
+    global _redis
+    _redis = connection
+
+
+def count_stat(name, n=1):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + n
+
+
+def stats():
+    with _stats_lock:
+        current = dict(_stats)
+    current['saved_upstream_requests'] = current.get('coalesced_requests', 0) + current.get('coalesced_remote', 0)
+    with _nodes_lock:
+        current['nodes'] = dict((name, {'breaker': node.breaker.state, 'failures': node.breaker.failures,
+                                        'outstanding': node.outstanding, 'latency': round(node.latency, 3),
+                                        'ejected': not node.available(), 'leader': node is _leader})
+                                for name, node in _nodes.items())
+    return current
+
+
+def _parse(text):
+    try:
+        return eval(text)
+    except (NameError, SyntaxError): # Not a python response, e.g. CSV
+        return text
+
+
+def _upstream_get(path, node=None, operation='read'):
+    count_stat('upstream_requests')
+    return call(operation, 'GET', path, node=node).text
+
+
+def _remote_single_flight(path, node=None):
+    url = path
+    if node is not None:
+        url = node.url(path)
+    if _redis is None:
+        return _upstream_get(path, node=node)
+    key = 'hb2:solr:flight:%s' % hashlib.sha1(url.encode('utf-8')).hexdigest()
+    window = secrets.SOLR_COALESCE_WINDOW
+    # Each flight publishes its result under its own token, so no request gets the result of an earlier flight
+    token = uuid.uuid4().hex
+    if _redis.set('%s:lock' % key, token, nx=True, px=window * 20):
+        try:
+            text = _upstream_get(path, node=node)
+            _redis.set('%s:result:%s' % (key, token), text, px=window)
+        finally:
+            if _redis.get('%s:lock' % key) == token.encode('utf-8'):
+                _redis.delete('%s:lock' % key)
+        return text
+    token = _redis.get('%s:lock' % key)
+    if token is None:
+        # The flight just landed
+        return _upstream_get(path, node=node)
+    result_key = '%s:result:%s' % (key, token.decode('utf-8'))
+    wait = 0.01
+    while True:
+        text = _redis.get(result_key)
+        if text is not None:
+            count_stat('coalesced_remote')
+            return text.decode('utf-8')
+        if _redis.get('%s:lock' % key) != token:
+            # The flight landed in the meantime or the other process gave up
+            text = _redis.get(result_key)
+            if text is not None:
+                count_stat('coalesced_remote')
+                return text.decode('utf-8')
+            return _upstream_get(path, node=node)
+        time.sleep(wait)
+        wait = min(wait * 2, 0.1)
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+def coalesced_get(path, node=None):
+    if not secrets.SOLR_COALESCE:
+        return _parse(_upstream_get(path, node=node))
+    url = path
+    if node is not None:
+        url = node.url(path)
+    with _flights_lock:
+        flight = _flights.get(url)
+        leader = flight is None
+        if leader:
+            flight = _flights[url] = _Flight()
+    if not leader:
+        count_stat('coalesced_requests')
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.response
+    try:
+        flight.response = _parse(_remote_single_flight(path, node=node))
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[url]
+        flight.done.set()
+    return flight.response
+
+
 class Solr(object):
-    def __init__(self, host=secrets.SOLR_HOST, port=secrets.SOLR_PORT, application='solr', handler='select',
+    def __init__(self, host=None, port=None, application='solr', handler='select',
                  query='*:*', fquery=[], fields=[], writer='python', start='0', rows='10', facet='false',
                  facet_fields=secrets.SOLR_FACETS, facet_mincount=0, facet_limit=10, facet_offset=0, sort='score desc',
                  terms_fl='', terms_limit=10, terms_prefix='', terms_sort='count', mlt=False, mlt_fields=[],
                  omitHeader='false', query_field='', sort_facet_by_index={}, fuzzy='false',
                  compress=False, facet_sort='count', facet_tree=(), spellcheck='false', spellcheck_collate='false',
                  spellcheck_count=5, suggest_query='', group='false', group_field='', group_limit=1,
-                 group_sort='score desc', group_ngroups='true', coordinates='0,0', json_nl='arrmap',# cursor='',
+                 group_sort='score desc', group_ngroups='true', coordinates='0,0', json_nl='arrmap', cursor='',
                  boost_most_recent='false', csv_separator='\t', core=secrets.SOLR_CORE, stats='false', stats_fl=[],
-                 data='', del_id='', export_field='', json_facet={}):
+                 data='', del_id='', export_field='', json_facet={}, commit='true', compact=False, bulk=False):
         self.host = host
         self.port = port
+        # Without an explicit host, reads are balanced over SOLR_READ_NODES and writes go to SOLR_WRITE_NODE
+        self.node = None
+        if host:
+            self.node = get_node(host, port or secrets.SOLR_PORT)
         self.application = application
         self.handler = handler
         self.query = query
@@ -92,7 +553,8 @@ class Solr(object):
         self.defType = 'edismax'
         self.queryField = query_field
         self.fuzzy = fuzzy
-        #self.cursor = cursor
+        self.cursor = cursor
+        self.next_cursor = ''
         self.boost_most_recent = boost_most_recent
         self.csv_separator = csv_separator
         self.request_url = ''
@@ -104,10 +566,18 @@ class Solr(object):
         self.export_field = export_field
         #self.export_dir = export_dir
         self.json_facet = json_facet
+        self.commit = commit
+        # Return the docs as ResultRows of the requested fields instead of dicts
+        self.compact = compact
+        # Scans of the whole index are sent uncoalesced as 'export' operations
+        self.bulk = bulk
 
     def request(self):
         params = ''
-        url = 'http://%s:%s/%s/' % (self.host, self.port, self.application)
+        if self.cursor:
+            # Deep paging with cursorMark always starts at 0, the cursor marks the position
+            self.start = 0
+        url = '/%s/' % self.application
         if self.core != '':
             url += '%s/' % self.core
         fuzzy_tilde = ''
@@ -156,10 +626,13 @@ class Solr(object):
                     params += '&fq=%s' % urllib.parse.unquote(fq)
                 except UnicodeDecodeError:
                     params += '&fq=%s' % urllib.parse.unquote(fq)
-        if self.sort:
-            #if self.cursor:
-                #params += '&sort=katkey+asc&cursorMark=%s' % self.cursor
-            #elif self.sort != 'score desc':
+        if self.cursor:
+            # cursorMark needs the uniqueKey as a tie breaker in the sort
+            sort = self.sort or 'score desc'
+            if not re.search(r'(^|,)\s*id\s', sort):
+                sort += ',id asc'
+            params += '&sort=%s&cursorMark=%s' % (sort, urllib.parse.quote(self.cursor, safe=''))
+        elif self.sort:
             if self.sort != 'score desc':
                 params += '&sort=%s' % self.sort
         if len(self.fields) > 0:
@@ -176,7 +649,7 @@ class Solr(object):
             #self.response = eval(urllib.request.urlopen('%s%s' % (url, mparams)).read())
             #logging.info(url)
             #logging.info(mparams)
-            self.response = eval(requests.get('%s%s' % (url, mparams)).text)
+            self.response = coalesced_get('%s%s' % (url, mparams), node=self.node)
             for mlt in self.response.get('moreLikeThis'):
                 self.mlt_results = self.response.get('moreLikeThis').get(mlt).get('docs')
         if self.spellcheck == 'true':
@@ -211,21 +684,19 @@ class Solr(object):
             gzipper = gzip.GzipFile(fileobj=compressedstream)
 
             self.response = eval(gzipper.read())
+        elif self.bulk:
+            self.response = _parse(_upstream_get(iri_to_uri(self.request_url), node=self.node, operation='export'))
         else:
             #logging.error(self.request_url)
-            try:
-                #self.response = eval(urllib.request.urlopen(iri_to_uri(self.request_url)).read())
-                self.response = eval(requests.get(iri_to_uri(self.request_url)).text)
-            except NameError:
-                #self.response = urllib.request.urlopen(iri_to_uri(self.request_url)).read()
-                self.response = requests.get(iri_to_uri(self.request_url)).text
-            except SyntaxError:
-                #self.response = urllib.request.urlopen(iri_to_uri(self.request_url)).read()
-                self.response = requests.get(iri_to_uri(self.request_url)).text
-            #self.response = eval(urllib.request.urlopen(self.request_url).read())
+            self.response = coalesced_get(iri_to_uri(self.request_url), node=self.node)
         #logging.error(self.response)
         try:
             self.results = self.response.get('response').get('docs')
+            if self.compact and self.fields:
+                self.results = [row_type(self.fields)(doc) for doc in self.results]
+                # Drop the dicts. The parsed response may be shared with coalesced requests, so it is copied, not
+                # changed.
+                self.response = dict(self.response, response=dict(self.response.get('response'), docs=self.results))
         except AttributeError: # Grouped results...
             #logging.fatal(e)
             #logging.error(self.response)
@@ -234,6 +705,8 @@ class Solr(object):
                     self.results = self.response.get('grouped').get(self.group_field[0]).get('groups')
             except AttributeError:
                 pass
+        if self.cursor:
+            self.next_cursor = self.response.get('nextCursorMark', '')
         if self.facet == 'true':
             self.facets = self.response.get('facet_counts').get('facet_fields')
         if len(self.facet_tree) > 0:
@@ -251,7 +724,7 @@ class Solr(object):
             #logging.error(self.qtime)
 
     def suggest(self):
-        url = 'http://%s:%s/%s/' % (self.host, self.port, self.application)
+        url = '/%s/' % self.application
         if self.core != '':
             url += '%s/' % self.core
         params = '%s?spellcheck.q=%s&wt=%s&json.nl=%s&omitHeader=%s' % (self.handler,
@@ -260,11 +733,11 @@ class Solr(object):
                                                                            self.writer, self.json_nl, self.omitHeader)
         self.request_url = '%s%s' % (url, params)
         #self.response = eval(urllib.request.urlopen(iri_to_uri(self.request_url)).read())
-        self.response = eval(requests.get(iri_to_uri(self.request_url)).text)
+        self.response = coalesced_get(iri_to_uri(self.request_url), node=self.node)
         self.suggestions = self.response.get('spellcheck').get('suggestions')
 
     def terms(self):
-        url = 'http://%s:%s/%s/' % (self.host, self.port, self.application)
+        url = '/%s/' % self.application
         if self.core != '':
             url += '%s/' % self.core
         params = '%s?terms.fl=%s&terms.limit=%s&terms.sort=%s&wt=%s&json.nl=%s&omitHeader=%s' % (
@@ -274,7 +747,7 @@ class Solr(object):
             params += '&terms.prefix=%s' % self.terms_prefix
         self.request_url = '%s%s' % (url, params)
         #self.response = eval(urllib.request.urlopen(self.request_url).read())
-        self.response = eval(requests.get(self.request_url).text)
+        self.response = coalesced_get(self.request_url, node=self.node)
         self.results = self.response.get('terms').get(self.terms_fl)
 
     def count(self):
@@ -287,32 +760,39 @@ class Solr(object):
         return self._count
 
     def update(self):
-        url = 'http://%s:%s/%s/%s/update/?commit=true&versions=true' % (self.host, self.port, self.application, self.core)
-        resp = requests.post(url, headers={'Content-type': 'application/json'}, data=json.dumps(self.data))
+        url = '/%s/%s/update/?commit=%s&versions=true' % (self.application, self.core, self.commit)
+        resp = call('write', 'POST', url, node=self.node, headers={'Content-type': 'application/json'}, data=json.dumps(self.data))
         return resp
 
     def delete(self):
-        url = 'http://%s:%s/%s/%s/update?commit=true' % (self.host, self.port, self.application, self.core)
-        resp = requests.post(url, headers={'Content-type': 'application/json'}, data=json.dumps({'delete': {'id': self.del_id}}))
+        url = '/%s/%s/update?commit=%s' % (self.application, self.core, self.commit)
+        resp = call('write', 'POST', url, node=self.node, headers={'Content-type': 'application/json'}, data=json.dumps({'delete': self._delete_ids()}))
         return resp.status_code
 
-    def export(self):
-        done = False
+    def _delete_ids(self):
+        if isinstance(self.del_id, list):
+            return self.del_id
+        return {'id': self.del_id}
+
+    def export_iter(self):
+        '''
+        Yield the decoded export field of every doc in the core matching the filter queries, paging through the index
+        with cursorMark.
+        '''
         cm = '*'
-        export_docs = []
-        while not done:
-            resp = requests.get('http://%s:%s/%s/%s/query?q=*:*&sort=id asc&fl=%s&cursorMark=%s' % (self.host, self.port, self.application, self.core, self.export_field, cm)).json()
+        fqs = ''.join('&fq=%s' % urllib.parse.quote(fq) for fq in self.fquery)
+        while True:
+            resp = call('export', 'GET', '/%s/%s/query?q=*:*%s&sort=id asc&fl=%s&rows=%s&cursorMark=%s' % (
+                self.application, self.core, fqs, self.export_field, self.rows, urllib.parse.quote(cm, safe='')),
+                node=self.node).json()
             for doc in resp.get('response').get('docs'):
-                export_docs.append(json.loads(doc.get(self.export_field)))
+                yield get_wtf_json(doc, self.export_field)
             if cm == resp.get('nextCursorMark'):
-                done = True
+                break
             cm = resp.get('nextCursorMark')
 
-        #with open('%s/%s_%s.json' % (self.export_dir, self.core, int(time.time())), 'w') as dumpfile:
-            #json.dump(export_docs, dumpfile, indent=4)
-
-        #return '%s/%s_%s.json' % (self.export_dir, self.core, int(time.time()))
-        return export_docs
+    def export(self):
+        return list(self.export_iter())
 
     def __len__(self):
         return len(self.results)
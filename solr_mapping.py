@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+'''
+Declarative mappings from wtf_json (or any other dict of source values) to Solr documents.
+
+A mapping table maps a source field to a list of rules (target field, transform, mode) or to a handler function
+handler(value, record, doc) for the cases a rule can't express. compile_mapping() turns a table into a converter
+once, so converting a record is a single dict lookup per source field. The modes are:
+
+SET     doc[target] = transform(value), unless the target is already set
+FIRST   like SET with the first item of a list value
+APPEND  append transform(value) to the list in doc[target]
+EACH    append transform(item) for every item of a list value
+
+A target is either a single value (SET, FIRST) or a list (APPEND, EACH), compile_mapping() rejects tables mixing
+both for one target. A transform may return SKIP to leave the target alone. Handler functions declare the Solr fields they write in a
+targets attribute, so affected_targets() can tell which Solr fields a change to some source fields touches.
+
+Records can be checked against a schema derived from their form class with validate() before they are converted,
+so bulk indexing needs no form objects.
+'''
+
+from wtforms import BooleanField, FieldList, FileField, FormField, SelectMultipleField
+from wtforms.fields.core import UnboundField
+
+SET = 'set'
+FIRST = 'first'
+APPEND = 'append'
+EACH = 'each'
+
+SKIP = object()
+
+
+def strip(value):
+    return value.strip()
+
+
+def timestamp(value):
+    return value.strip().replace(' ', 'T') + 'Z'
+
+
+def nonempty(transform=None):
+    '''Skip empty values, transform the others.'''
+    def convert(value):
+        if not value:
+            return SKIP
+        return transform(value) if transform else value
+    return convert
+
+
+def item(key, transform=None, required=True):
+    '''Transform the value of a key of a dict item. Items without a value for the key are skipped if required.'''
+    def convert(value):
+        value = value.get(key)
+        if required and not value:
+            return SKIP
+        return transform(value) if transform else value
+    return convert
+
+
+def first(transform=None):
+    '''Transform the first item of a list value, for APPEND rules. Empty lists are skipped.'''
+    def convert(values):
+        if not values:
+            return SKIP
+        return transform(values[0]) if transform else values[0]
+    return convert
+
+
+def _compile_rule(target, transform, mode):
+    if transform is None:
+        transform = lambda value: value
+
+    if mode == SET:
+        def handler(value, record, doc):
+            if target not in doc:
+                value = transform(value)
+                if value is not SKIP:
+                    doc[target] = value
+    elif mode == FIRST:
+        def handler(values, record, doc):
+            if target not in doc:
+                for value in values:
+                    value = transform(value)
+                    if value is not SKIP:
+                        doc[target] = value
+                        break
+    elif mode == APPEND:
+        def handler(value, record, doc):
+            value = transform(value)
+            if value is not SKIP:
+                doc.setdefault(target, []).append(value)
+    elif mode == EACH:
+        def handler(values, record, doc):
+            for value in values:
+                value = transform(value)
+                if value is not SKIP:
+                    doc.setdefault(target, []).append(value)
+    else:
+        raise ValueError('Unknown mapping mode: %s' % mode)
+    return handler
+
+
+def _compile_rules(rules):
+    if callable(rules):
+        return rules
+    handlers = [_compile_rule(*rule) for rule in rules]
+    if len(handlers) == 1:
+        handler = handlers[0]
+    else:
+        def handler(value, record, doc):
+            for rule in handlers:
+                rule(value, record, doc)
+    handler.targets = tuple(rule[0] for rule in rules)
+    return handler
+
+
+def _check_modes(table):
+    modes = {}
+    for field, rules in table.items():
+        if callable(rules):
+            continue
+        for target, transform, mode in rules:
+            modes.setdefault(target, {}).setdefault(mode in (APPEND, EACH), field)
+    for target, kinds in modes.items():
+        if len(kinds) > 1:
+            raise ValueError('Mapping writes %s both as a single value (%s) and as a list (%s)' % (
+                target, kinds.get(False), kinds.get(True)))
+
+
+def compile_mapping(table, default=None):
+    '''
+    Compile a mapping table into a function converting a record into a Solr document. Source fields are converted in
+    the order of the record, or only the given fields. Fields missing from the table are passed to
+    default(field, value, record, doc) if given.
+    '''
+    _check_modes(table)
+    handlers = dict((field, _compile_rules(rules)) for field, rules in table.items())
+
+    def convert(record, doc=None, fields=None):
+        if doc is None:
+            doc = {}
+        for field in record if fields is None else fields:
+            if field not in record:
+                continue
+            handler = handlers.get(field)
+            if handler is not None:
+                handler(record[field], record, doc)
+            elif default is not None:
+                default(field, record[field], record, doc)
+        return doc
+
+    convert.targets = dict((field, getattr(handler, 'targets', None)) for field, handler in handlers.items())
+    convert.sources = {}
+    for field, targets in convert.targets.items():
+        for target in targets or ():
+            convert.sources.setdefault(target, set()).add(field)
+    convert.default = default
+    return convert
+
+
+def affected_targets(convert, fields):
+    '''
+    Return the Solr fields a converter derives from the given source fields, or None if they can't be updated on
+    their own, because a handler doesn't declare its targets or a target is derived from other fields as well.
+    '''
+    affected = set()
+    for field in fields:
+        if field in convert.targets:
+            targets = convert.targets.get(field)
+        elif convert.default is not None:
+            targets = (field,)
+        else:
+            # Only kept in wtf_json
+            targets = ()
+        if targets is None:
+            return None
+        for target in targets:
+            if convert.sources.get(target, set()) - set([field]):
+                return None
+            affected.add(target)
+    return affected
+
+
+def copy_nonempty(field, value, record, doc):
+    if value:
+        doc.setdefault(field, value)
+
+
+# Records
+
+def _issued(issued, record, doc):
+    if issued:
+        date = issued.strip()
+        doc.setdefault('date', date)
+        doc.setdefault('fdate', issued[0:4].strip())
+        if len(date) == 4:
+            doc.setdefault('date_boost', '%s-01-01T00:00:00Z' % date)
+        elif len(date) == 7:
+            doc.setdefault('date_boost', '%s-01T00:00:00Z' % date)
+        else:
+            doc.setdefault('date_boost', '%sT00:00:00Z' % date)
+
+_issued.targets = ('date', 'fdate', 'date_boost')
+
+
+def _agents(name_field, facet_field, id_field, kind):
+    '''Names of persons or corporations with their GND ID or, lacking one, an ID local to the record.'''
+    def handler(agents, record, doc):
+        for idx, agent in enumerate(agents):
+            if agent.get('name'):
+                name = agent.get('name').strip()
+                doc.setdefault(name_field, []).append(name)
+                doc.setdefault(facet_field, []).append(name)
+                if agent.get('gnd'):
+                    doc.setdefault(id_field, []).append('%s#%s' % (agent.get('gnd').strip(), name))
+                else:
+                    doc.setdefault(id_field, []).append('%s#%s-%s#%s' % (record.get('id'), kind, idx, name))
+    handler.targets = (name_field, facet_field, id_field)
+    return handler
+
+
+RECORD_MAPPING = {
+    'id': [('id', strip, SET)],
+    'created': [('recordCreationDate', timestamp, SET)],
+    'changed': [('recordChangeDate', timestamp, SET)],
+    'owner': [('owner', strip, FIRST)],
+    'deskman': [('deskman', nonempty(strip), SET)],
+    'editorial_status': [('editorial_status', strip, SET)],
+    'publication_status': [('publication_status', strip, SET)],
+    'pubtype': [('pubtype', strip, SET)],
+    'title': [('title', strip, SET), ('exacttitle', strip, SET), ('sorttitle', strip, SET)],
+    'translated_title': [('parallel_title', strip, FIRST)],
+    'issued': _issued,
+    'publisher': [('publisher', strip, SET)],
+    'language': [('language', None, EACH)],
+    'locked': [('locked', None, SET)],
+    'person': _agents('person', 'fperson', 'pnd', 'person'),
+    'corporation': _agents('institution', 'fcorporation', 'gkd', 'corporation'),
+    'description': [('ro_abstract', strip, SET)],
+    'container_title': [('journal_title', strip, SET), ('fjtitle', strip, SET)],
+    'apparent_dup': [('apparent_dup', None, SET)],
+    'ISSN': [('issn', strip, FIRST), ('isxn', strip, FIRST)],
+    'ISBN': [('isbn', strip, FIRST), ('isxn', strip, FIRST)],
+    'PMID': [('pmid', strip, SET)],
+    'DOI': [('doi', strip, SET)],
+    'WOSID': [('isi_id', strip, SET)],
+}
+
+# The relations of a record need Solr lookups and are indexed by hb2_flask._record2solr_doc
+record2solr = compile_mapping(RECORD_MAPPING)
+
+
+# Persons
+
+def _project_id(project):
+    if project.get('project_id') and project.get('label'):
+        return '%s#%s' % (project.get('project_id').strip(), project.get('label').strip())
+    return SKIP
+
+
+PERSON_MAPPING = {
+    'name': [('name', strip, APPEND)],
+    'former_name': [('name', strip, APPEND)],
+    'gnd': [('gnd', strip, SET)],
+    'id': [('id', None, SET)],
+    'created': [('created', timestamp, SET)],
+    'changed': [('changed', timestamp, SET)],
+    'research_interest': [('research_interest', strip, EACH)],
+    'url': [('url', item('label', strip, required=False), EACH)],
+    'membership': [('membership', item('label', strip), EACH)],
+    'award': [('award', item('label', strip), EACH)],
+    'project': [('project', item('label', strip), EACH), ('project_id', _project_id, EACH),
+                ('project_type', item('project_type'), EACH)],
+    'thesis': [('thesis', item('label', strip), EACH)],
+    'affiliation': [('affiliation', item('label', strip), EACH)],
+    'cv': [('cv', item('label', strip), EACH)],
+    'editor': [('editor', item('label', strip), EACH), ('editor_issn', item('issn'), EACH),
+               ('editor_zdbid', item('zdbid'), EACH)],
+    'reviewer': [('reviewer', item('label', strip), EACH), ('reviewer_issn', item('issn'), EACH),
+                 ('reviewer_zdbid', item('zdbid'), EACH)],
+}
+
+person2solr = compile_mapping(PERSON_MAPPING, default=copy_nonempty)
+
+
+# Organisations
+
+ORGA_MAPPING = {
+    'orga_id': [('id', None, SET)],
+    'alt_label': [('alt_label', strip, EACH)],
+    'created': [('created', timestamp, SET)],
+    'changed': [('changed', timestamp, SET)],
+    'destatis': [('destatis_label', item('destatis_label', strip), EACH),
+                 ('destatis_id', item('destatis_id', strip), EACH)],
+}
+
+orga2solr = compile_mapping(ORGA_MAPPING, default=copy_nonempty)
+
+
+# Validation
+
+STRING = 'string'
+BOOLEAN = 'boolean'
+ANY = 'any'
+
+_schemas = {}
+
+
+def _field_schema(unbound):
+    field_class = unbound.field_class
+    if issubclass(field_class, FieldList):
+        return [_field_schema(unbound.args[0])]
+    if issubclass(field_class, FormField):
+        return schema(unbound.args[0])
+    if issubclass(field_class, SelectMultipleField):
+        return [STRING]
+    if issubclass(field_class, BooleanField):
+        return BOOLEAN
+    if issubclass(field_class, FileField):
+        return ANY
+    return STRING
+
+
+def schema(form_class):
+    '''
+    Return the schema of the data of a form class: a dict of field names to STRING, BOOLEAN or ANY, to a nested
+    schema for sub forms and to a one-element list for lists. Schemas are built once per class.
+    '''
+    if form_class not in _schemas:
+        fields = {}
+        for name in dir(form_class):
+            unbound = getattr(form_class, name, None)
+            if isinstance(unbound, UnboundField):
+                fields[name] = _field_schema(unbound)
+        _schemas[form_class] = fields
+    return _schemas[form_class]
+
+
+def validate(record, record_schema, path=''):
+    '''
+    Return a list of the fields of a record that have the wrong type. Like the forms, validation ignores fields the
+    schema doesn't know.
+    '''
+    errors = []
+    if not isinstance(record, dict):
+        return ['%s: expected an object' % (path or 'record')]
+    for field, value in record.items():
+        if field in record_schema:
+            errors.extend(_validate_value(value, record_schema[field], '%s.%s' % (path, field) if path else field))
+    return errors
+
+
+def _validate_value(value, field_schema, name):
+    if value is None or field_schema == ANY:
+        return []
+    if isinstance(field_schema, dict):
+        return validate(value, field_schema, name)
+    if isinstance(field_schema, list):
+        if not isinstance(value, list):
+            return ['%s: expected a list' % name]
+        errors = []
+        for idx, item_value in enumerate(value):
+            errors.extend(_validate_value(item_value, field_schema[0], '%s[%s]' % (name, idx)))
+        return errors
+    if field_schema == BOOLEAN and not isinstance(value, bool):
+        return ['%s: expected a boolean' % name]
+    if field_schema == STRING and not isinstance(value, str):
+        return ['%s: expected a string' % name]
+    return []
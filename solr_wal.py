@@ -0,0 +1,213 @@
+# The MIT License
+#
+#  Copyright 2015 UB Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+
+import logging
+import time
+import uuid
+
+import simplejson as json
+from redis import RedisError
+
+from solr_handler import Solr, SolrUnavailable
+
+try:
+    import site_secrets as secrets
+except ImportError:
+    import secrets
+
+WAL_KEY = 'hb2:wal'
+DEAD_LETTER_KEY = 'hb2:wal:dead'
+LOCK_KEY = 'hb2:wal:lock'
+RESULT_KEY = 'hb2:wal:result:%s'
+
+
+class LoggedResponse(object):
+    '''The status code and text of Solr's response to a logged update.'''
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+
+class WriteAheadLog(object):
+    '''
+    Updates and deletes are appended to a Redis list before they are sent to Solr and removed only after Solr accepted
+    them, so edits survive Solr outages. The log is replayed in order by one process at a time, consecutive writes to
+    the same core in batches of SOLR_WAL_BATCH_SIZE. Writers wait up to SOLR_WAL_WAIT seconds for the outcome of their
+    entry, which the replaying process publishes in Redis. Entries Solr rejects with a client error while nobody waits
+    for them are moved to the dead-letter list. Documents are written by ID, so replaying an entry twice is harmless,
+    unless it carries a _version_: the second write is rejected with a 409 and lands on the dead-letter list. Such
+    entries are sent on their own, so they are replayed again only if the replaying process dies between sending and
+    removing them. If Redis is unavailable, writes are sent directly.
+    '''
+    def __init__(self, redis):
+        self.redis = redis
+
+    def update(self, solr):
+        '''Log and send the documents of a Solr object. Returns the Solr response or None if the write is pending.'''
+        return self._submit(solr, {'op': 'update', 'data': solr.data})
+
+    def delete(self, solr):
+        '''Log and send the deletes of a Solr object. Returns the status code or None if the delete is pending.'''
+        ids = solr.del_id
+        if not isinstance(ids, list):
+            ids = [ids]
+        return self._submit(solr, {'op': 'delete', 'ids': ids})
+
+    def _submit(self, solr, entry):
+        entry.update({'id': str(uuid.uuid4()), 'core': solr.core, 'commit': solr.commit, 'logged': time.time()})
+        try:
+            if self.redis.llen(WAL_KEY) >= secrets.SOLR_WAL_BATCH_SIZE:
+                # Solr has been unavailable for a while, leave the backlog to the replayer
+                entry['wait'] = 0
+                self.redis.rpush(WAL_KEY, json.dumps(entry))
+                return None
+            entry['wait'] = time.time() + secrets.SOLR_WAL_WAIT
+            self.redis.rpush(WAL_KEY, json.dumps(entry))
+        except RedisError as e:
+            logging.error(e)
+            return self._send(entry.get('op'), solr.core, solr.commit, entry.get('data') or entry.get('ids'))
+        try:
+            while True:
+                # The entry may be sent by this or another process, whichever holds the lock
+                self.replay()
+                outcome = self._outcome(entry)
+                if outcome is not None:
+                    return outcome
+                if time.time() > entry.get('wait'):
+                    # The outcome may have been published just before the deadline
+                    return self._outcome(entry)
+                time.sleep(0.05)
+        except RedisError as e:
+            logging.error(e)
+            return None
+
+    def _outcome(self, entry):
+        outcome = self.redis.get(RESULT_KEY % entry.get('id'))
+        if outcome is None:
+            return None
+        outcome = json.loads(outcome)
+        if entry.get('op') == 'delete':
+            return outcome.get('status')
+        return LoggedResponse(outcome.get('status'), outcome.get('text'))
+
+    def _publish(self, entry, resp):
+        if isinstance(resp, int):
+            outcome = {'status': resp, 'text': ''}
+        else:
+            outcome = {'status': resp.status_code, 'text': resp.text[:500]}
+        self.redis.set(RESULT_KEY % entry.get('id'), json.dumps(outcome), ex=secrets.SOLR_WAL_RESULT_TTL)
+
+    def _send(self, op, core, commit, items):
+        if op == 'delete':
+            return Solr(core=core, del_id=items, commit=commit).delete()
+        return Solr(core=core, data=items, commit=commit).update()
+
+    def _status(self, resp):
+        return resp if isinstance(resp, int) else resp.status_code
+
+    def replay(self):
+        '''
+        Send the logged writes to Solr until the log is empty or Solr is unavailable. Returns False if another process
+        is replaying.
+        '''
+        token = str(uuid.uuid4())
+        if not self.redis.set(LOCK_KEY, token, nx=True, ex=secrets.SOLR_WAL_LOCK_TIMEOUT):
+            return False
+        try:
+            while True:
+                entries = [json.loads(entry) for entry in
+                           self.redis.lrange(WAL_KEY, 0, secrets.SOLR_WAL_BATCH_SIZE - 1)]
+                if not entries:
+                    break
+                for batch in self._batches(entries):
+                    try:
+                        self._replay_batch(batch)
+                    except SolrUnavailable as e:
+                        logging.error('Solr write-ahead log replay stopped with %s entries left: %s' % (
+                            self.depth(), e))
+                        return True
+                    # Only the replaying process removes entries from the head, writers append at the tail
+                    self.redis.ltrim(WAL_KEY, len(batch), -1)
+                    self.redis.expire(LOCK_KEY, secrets.SOLR_WAL_LOCK_TIMEOUT)
+        finally:
+            if self.redis.get(LOCK_KEY) == token.encode('utf-8'):
+                self.redis.delete(LOCK_KEY)
+        return True
+
+    def _versioned(self, entry):
+        return any('_version_' in doc for doc in entry.get('data') or [])
+
+    def _batches(self, entries):
+        batch = []
+        for entry in entries:
+            if batch and (self._versioned(entry) or self._versioned(batch[0]) or
+                          (entry.get('op'), entry.get('core')) != (batch[0].get('op'), batch[0].get('core'))):
+                yield batch
+                batch = []
+            batch.append(entry)
+        if batch:
+            yield batch
+
+    def _replay_batch(self, batch):
+        op = batch[0].get('op')
+        items = []
+        for entry in batch:
+            items.extend(entry.get('data') or entry.get('ids') or [])
+        commit = 'true' if any(entry.get('commit') == 'true' for entry in batch) else 'false'
+        resp = self._send(op, batch[0].get('core'), commit, items)
+        if self._status(resp) < 400:
+            for entry in batch:
+                if entry.get('wait', 0) > time.time():
+                    self._publish(entry, resp)
+            return
+        if len(batch) > 1:
+            # Find the rejected entries, the others are written one by one
+            for entry in batch:
+                self._replay_batch([entry])
+            return
+        entry = batch[0]
+        # Publish before checking the deadline, writers look for the outcome once more after it passed
+        self._publish(entry, resp)
+        if entry.get('wait', 0) < time.time():
+            entry['status'] = self._status(resp)
+            entry['error'] = '' if isinstance(resp, int) else resp.text[:500]
+            logging.error('Solr rejected logged %s of %s: HTTP %s' % (op, entry.get('core'), entry.get('status')))
+            self.redis.rpush(DEAD_LETTER_KEY, json.dumps(entry))
+
+    def depth(self):
+        return self.redis.llen(WAL_KEY)
+
+    def dead_letters(self):
+        return self.redis.llen(DEAD_LETTER_KEY)
+
+    def run(self):
+        '''Replay the log every SOLR_WAL_REPLAY_INTERVAL seconds. Blocks, so run it in a thread.'''
+        while True:
+            try:
+                if self.depth():
+                    self.replay()
+            except RedisError as e:
+                logging.error(e)
+            except Exception as e:
+                logging.exception(e)
+            time.sleep(secrets.SOLR_WAL_REPLAY_INTERVAL)
@@ -0,0 +1,50 @@
+# The MIT License
+#
+#  Copyright 2015-2016 University Library Bochum <bibliographie-ub@rub.de>.
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in
+#  all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#  THE SOFTWARE.
+
+import unittest
+
+from solr_mapping import compile_mapping, first, APPEND, EACH, FIRST, SET
+
+
+class MixedModesTest(unittest.TestCase):
+
+    def test_scalar_and_list_modes_on_one_target_are_rejected(self):
+        for scalar in (SET, FIRST):
+            for listed in (APPEND, EACH):
+                table = {'a': [('number', None, scalar)], 'b': [('number', None, listed)]}
+                self.assertRaises(ValueError, compile_mapping, table)
+
+    def test_list_modes_on_one_target_collect_all_values(self):
+        convert = compile_mapping({'a': [('number', first(), APPEND)], 'b': [('number', None, EACH)]})
+        self.assertEqual(convert({'a': ['1', '2'], 'b': ['3', '4']}, fields=['a', 'b']), {'number': ['1', '3', '4']})
+        self.assertEqual(convert({'a': ['1', '2'], 'b': ['3', '4']}, fields=['b', 'a']), {'number': ['3', '4', '1']})
+
+
+    def test_empty_element_lists_are_skipped(self):
+        convert = compile_mapping({'a': [('number', first(), APPEND)], 'b': [('number', None, EACH)],
+                                   'c': [('title', None, FIRST)]})
+        self.assertEqual(convert({'a': [], 'b': [], 'c': []}), {})
+        self.assertEqual(convert({'a': [], 'b': ['3']}, fields=['a', 'b']), {'number': ['3']})
+
+
+if __name__ == '__main__':
+    unittest.main()